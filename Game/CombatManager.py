@@ -1,12 +1,16 @@
 class CombatManager:
     def attack(self, attacker, defender):
-        damage = attacker['components']['stats']['strength']
-        defender['components']['stats']['health'] -= damage
+        damage = attacker.strength
+        defender.health -= damage
+        defender.markDirty('stats')
 
-        if defender['components']['stats']['health'] <= 0:
-            defender['active'] = False
-            defender['updated'] = True
+        # Players don't have a name component
+        name = defender.getComponent('name', 'a player')
 
-            return 'You defeated ' + defender['components']['name'] + ' [' + str(damage) + ' damage]'  # noqa
+        if defender.health <= 0:
+            defender.active = False
+            defender.updated = True
+
+            return 'You defeated ' + name + ' [' + str(damage) + ' damage]'
         else:
-            return 'You attacked ' + defender['components']['name'] + ' for ' + str(damage) + ' damage'  # noqa
+            return 'You attacked ' + name + ' for ' + str(damage) + ' damage'
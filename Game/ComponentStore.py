@@ -0,0 +1,446 @@
+from array import array
+
+
+# Stores the components of entities in columns: one array per field, with
+#     each entity given a row in every column. Components that AI and combat
+#     read all the time (position, stats, range and movement) are kept in
+#     columns, so that an entity only costs a few numbers instead of a dict
+#     per component. Other components (name, sprite, etc.) are kept in each
+#     entity's record.
+# Rows of removed entities are reused by new ones
+class ComponentStore:
+    # Bits of the component mask, which says which column components an
+    #     entity has
+    POSITION = 1
+    STATS = 2
+    RANGE = 4
+    MOVEMENT = 8
+
+    column_components = {
+        'position': POSITION,
+        'stats': STATS,
+        'range': RANGE,
+        'movement': MOVEMENT
+    }
+
+    # The columns that are packed by packRows, and their array type codes
+    packed_columns = [
+        ('mask', 'B'),
+        ('x', 'i'),
+        ('y', 'i'),
+        ('health', 'i'),
+        ('strength', 'i'),
+        ('range', 'i'),
+        ('movement', 'B')
+    ]
+
+    def __init__(self):
+        self.rows = {}  # Entity ID -> row
+        self.records = []  # Row -> Entity, or None if the row is free
+        self.free_rows = []
+
+        # The columns. Row -> field value
+        self.mask = bytearray()
+        self.active = bytearray()
+        self.x = array('i')
+        self.y = array('i')
+        self.health = array('i')
+        self.strength = array('i')
+        self.range = array('i')
+        self.movement = array('B')  # Index into movement_types
+        self.level = array('i')  # Index into level_ids, or -1
+
+        # Movement types are stored as numbers. The first means no movement
+        self.movement_types = [None]
+        self.movement_codes = {None: 0}
+
+        # Levels are stored as numbers too
+        self.level_ids = []
+        self.level_codes = {}
+
+        # The rows of the entities on each level, in the order they were put
+        #     there. Level ID -> row -> True
+        self.level_rows = {}
+
+        # Bits used to mark which components of an entity have changed.
+        #     Column components use their mask bits, and other component
+        #     types are given bits as they're first seen
+        self.component_bits = dict(self.column_components)
+
+    # Adds an entity to the store, and returns its record.
+    # base is a dict of components shared by every entity of its type, which
+    #     is never changed
+    def add(self, ent_id, entity_type=None, base=None):
+        if self.free_rows:
+            row = self.free_rows.pop()
+
+            self.mask[row] = 0
+            self.active[row] = 1
+            self.x[row] = 0
+            self.y[row] = 0
+            self.health[row] = 0
+            self.strength[row] = 0
+            self.range[row] = 0
+            self.movement[row] = 0
+            self.level[row] = -1
+        else:
+            row = len(self.records)
+
+            self.records.append(None)
+            self.mask.append(0)
+            self.active.append(1)
+            self.x.append(0)
+            self.y.append(0)
+            self.health.append(0)
+            self.strength.append(0)
+            self.range.append(0)
+            self.movement.append(0)
+            self.level.append(-1)
+
+        entity = Entity(self, row, ent_id, entity_type, base)
+
+        self.rows[ent_id] = row
+        self.records[row] = entity
+
+        return entity
+
+    def remove(self, ent_id):
+        row = self.rows.pop(ent_id, None)
+
+        if row is None:
+            return
+
+        self.setLevel(row, None)
+
+        self.records[row] = None
+        self.active[row] = 0
+        self.free_rows.append(row)
+
+    def get(self, ent_id):
+        return self.records[self.rows[ent_id]]
+
+    def has(self, ent_id):
+        return ent_id in self.rows
+
+    # Moves the entity in a row onto a level (or off every level, if level_id
+    #     is None)
+    def setLevel(self, row, level_id):
+        code = self.level[row]
+
+        if code != -1:
+            if self.level_ids[code] == level_id:
+                return
+
+            del self.level_rows[self.level_ids[code]][row]
+
+        if level_id is None:
+            self.level[row] = -1
+            return
+
+        if level_id not in self.level_codes.keys():
+            self.level_codes[level_id] = len(self.level_ids)
+            self.level_ids.append(level_id)
+
+        self.level[row] = self.level_codes[level_id]
+
+        if level_id not in self.level_rows.keys():
+            self.level_rows[level_id] = {}
+
+        self.level_rows[level_id][row] = True
+
+    def getLevel(self, row):
+        code = self.level[row]
+
+        if code == -1:
+            return None
+
+        return self.level_ids[code]
+
+    # Returns the rows of the active entities on a level that have every
+    #     component in a mask, e.g. query(level_id, POSITION | MOVEMENT)
+    def query(self, level_id, mask=0):
+        rows = self.level_rows.get(level_id)
+
+        if not rows:
+            return []
+
+        masks = self.mask
+        active = self.active
+
+        return [
+            row for row in rows
+            if active[row] and masks[row] & mask == mask
+        ]
+
+    # Returns a copy of the columns that can be read (e.g. by another thread)
+    #     while this store keeps changing. Records are shared, not copied
+    def copy(self):
+        store = ComponentStore()
+
+        for name, typecode in self.packed_columns:
+            setattr(store, name, getattr(self, name)[:])
+
+        store.active = self.active[:]
+        store.records = self.records[:]
+        store.movement_types = self.movement_types[:]
+
+        return store
+
+    # Copies the fields of some rows, e.g. for saving. Returns the packed
+    #     columns one after another, in native byte order. Movements are
+    #     packed as codes into movement_types
+    def packRows(self, rows):
+        data = bytearray()
+
+        for name, typecode in self.packed_columns:
+            column = getattr(self, name)
+            data += array(typecode, map(column.__getitem__, rows)).tobytes()
+
+        return bytes(data)
+
+    # Sets the fields of rows from packed columns. movement_types are those of
+    #     the store that the rows were packed from
+    def unpackRows(self, rows, data, movement_types):
+        offset = 0
+
+        for name, typecode in self.packed_columns:
+            values = array(typecode)
+            size = values.itemsize * len(rows)
+
+            values.frombytes(data[offset:offset + size])
+            offset += size
+
+            if name == 'movement':
+                codes = [self.movementCode(m) for m in movement_types]
+                values = map(codes.__getitem__, values)
+
+            column = getattr(self, name)
+
+            for row, value in zip(rows, values):
+                column[row] = value
+
+    def componentBit(self, component_type):
+        if component_type not in self.component_bits.keys():
+            self.component_bits[component_type] = 1 << len(self.component_bits)  # noqa
+
+        return self.component_bits[component_type]
+
+    def movementCode(self, movement):
+        if movement not in self.movement_codes.keys():
+            self.movement_codes[movement] = len(self.movement_types)
+            self.movement_types.append(movement)
+
+        return self.movement_codes[movement]
+
+
+# The record of an entity in a ComponentStore. Column components are read
+#     and written through the store; the rest are kept here.
+# getComponents and toDict give the entity in the same form as it is stored
+#     in level files and sent to clients:
+#     {'id', 'active', 'type', 'components': {...}}
+class Entity:
+    __slots__ = (
+        'store',
+        'row',
+        'id',
+        'type',
+        'base',  # Components shared with other entities of the same type
+        'components',  # Components of this entity only, or None
+        'combat',
+        'updated',  # Whether entity data has changed and needs to be sent to
+                    #     concerned players. True by default so that new
+                    #     entities get sent out
+        'dirty'  # Bits of the components that have changed since they were
+                 #     last sent, or ALL
+    )
+
+    ALL = -1
+
+    def __init__(self, store, row, ent_id, entity_type=None, base=None):
+        self.store = store
+        self.row = row
+        self.id = ent_id
+        self.type = entity_type
+        self.base = base
+        self.components = None
+        self.combat = None
+        self.updated = True
+        self.dirty = self.ALL
+
+    @property
+    def active(self):
+        return self.store.active[self.row] == 1
+
+    @active.setter
+    def active(self, value):
+        self.store.active[self.row] = 1 if value else 0
+
+    @property
+    def x(self):
+        return self.store.x[self.row]
+
+    @x.setter
+    def x(self, value):
+        self.store.x[self.row] = value
+
+    @property
+    def y(self):
+        return self.store.y[self.row]
+
+    @y.setter
+    def y(self, value):
+        self.store.y[self.row] = value
+
+    @property
+    def health(self):
+        return self.store.health[self.row]
+
+    @health.setter
+    def health(self, value):
+        self.store.health[self.row] = value
+
+    @property
+    def strength(self):
+        return self.store.strength[self.row]
+
+    @property
+    def range(self):
+        return self.store.range[self.row]
+
+    @property
+    def movement(self):
+        return self.store.movement_types[self.store.movement[self.row]]
+
+    @property
+    def level(self):
+        return self.store.getLevel(self.row)
+
+    @level.setter
+    def level(self, level_id):
+        self.store.setLevel(self.row, level_id)
+
+    def hasComponent(self, component_type):
+        store = self.store
+
+        if component_type in store.column_components.keys():
+            bit = store.column_components[component_type]
+            return store.mask[self.row] & bit != 0
+
+        if self.components and component_type in self.components:
+            return True
+
+        return self.base is not None and component_type in self.base
+
+    # Returns the data of a component. Column components are returned as new
+    #     dicts, so changing them doesn't change the entity
+    def getComponent(self, component_type, default=None):
+        store = self.store
+        row = self.row
+
+        if not self.hasComponent(component_type):
+            return default
+
+        if component_type == 'position':
+            return {
+                'x': store.x[row],
+                'y': store.y[row]
+            }
+        elif component_type == 'stats':
+            return {
+                'health': store.health[row],
+                'strength': store.strength[row]
+            }
+        elif component_type == 'range':
+            return store.range[row]
+        elif component_type == 'movement':
+            return self.movement
+
+        if self.components and component_type in self.components:
+            return self.components[component_type]
+
+        return self.base[component_type]
+
+    # Marks a component as changed, so that it will be sent to players. If no
+    #     component type is given, the whole entity is marked
+    def markDirty(self, component_type=None):
+        if component_type is None:
+            self.dirty = self.ALL
+        else:
+            self.dirty |= self.store.componentBit(component_type)
+
+        self.updated = True
+
+    def setComponent(self, component_type, data):
+        store = self.store
+        row = self.row
+
+        self.markDirty(component_type)
+
+        if component_type in store.column_components.keys():
+            bit = store.column_components[component_type]
+
+            if component_type == 'position':
+                store.x[row] = data['x']
+                store.y[row] = data['y']
+            elif component_type == 'stats':
+                store.health[row] = data.get('health', 0)
+                store.strength[row] = data.get('strength', 0)
+            elif component_type == 'range':
+                store.range[row] = data
+            elif component_type == 'movement':
+                store.movement[row] = store.movementCode(data)
+
+                # No movement is the same as not having the component
+                if not data:
+                    store.mask[row] &= ~bit
+                    return
+
+            store.mask[row] |= bit
+            return
+
+        if self.components is None:
+            self.components = {}
+
+        self.components[component_type] = data
+
+    # Returns the entity's components, as component type -> data. If a mask
+    #     of component bits is given (e.g. dirty), only those components are
+    #     returned
+    def getComponents(self, mask=ALL):
+        components = {}
+
+        if self.base:
+            components.update(self.base)
+
+        if self.components:
+            components.update(self.components)
+
+        for component_type in self.store.column_components.keys():
+            if self.hasComponent(component_type):
+                components[component_type] = self.getComponent(component_type)
+
+        if mask != self.ALL:
+            bits = self.store.component_bits
+
+            components = {
+                component_type: data
+                for component_type, data in components.items()
+                if component_type in bits and bits[component_type] & mask
+            }
+
+        return components
+
+    def toDict(self):
+        entity = {
+            'id': self.id,
+            'active': self.active,
+            'components': self.getComponents()
+        }
+
+        if self.type is not None:
+            entity['type'] = self.type
+
+        if self.combat is not None:
+            entity['combat'] = self.combat
+
+        return entity
@@ -1,13 +1,15 @@
 from log import log
 
+from . import ComponentStore
+
+from array import array
 import json
-import random
 
 
 class EntityManager:
     def __init__(self):
         self.id = 0
-        self.entities = {}
+        self.store = ComponentStore.ComponentStore()
 
         # Load pre-defined entities
         self.entity_types = {
@@ -16,113 +18,196 @@ class EntityManager:
             )
         }
 
+        # The furthest that any type of entity can notice players from
+        self.max_range = 0
+
+        for group in self.entity_types.values():
+            for entity_type in group.values():
+                self.max_range = max(
+                    self.max_range,
+                    entity_type['components'].get('range', 0)
+                )
+
+        # The components of each entity type, split into those kept in the
+        #     store's columns and those that every entity of the type shares.
+        # Entity type (e.g. "monsters.floating paper") -> component type ->
+        #     data
+        self.type_columns = {}
+        self.type_bases = {}
+
+        for group_name, group in self.entity_types.items():
+            for name, entity_type in group.items():
+                columns = {}
+                base = {}
+
+                for component_type, data in entity_type['components'].items():
+                    if component_type in self.store.column_components.keys():
+                        columns[component_type] = data
+                    else:
+                        base[component_type] = data
+
+                self.type_columns[group_name + '.' + name] = columns
+                self.type_bases[group_name + '.' + name] = base
+
     def addNew(self):
         ent_id = self.id
         self.id += 1
 
-        self.entities[ent_id] = {
-            'id': ent_id,
-            'active': True,
-            'components': {},
-            'updated': True  # Whether entity data has changed and needs to be
-                             #     sent to concerned players. True by default
-                             #     so that new entities get sent out
-        }
+        self.store.add(ent_id)
 
-        log('EntityManager', f'New entity added #{ent_id}', 'debug')
+        log('EntityManager', 'New entity added #{id}', 'debug', id=ent_id)
         return ent_id
 
+    # Adds an entity given as a dict (e.g. from a level file), and returns its
+    #     record. Entities with a type get the components of that type
     def addExistingEntity(self, entity):
         ent_id = self.id
         self.id += 1
 
-        entity['id'] = ent_id
-        entity['active'] = True
-        entity['updated'] = True
+        entity_type = entity.get('type')
+
+        record = self.store.add(
+            ent_id,
+            entity_type,
+            self.type_bases.get(entity_type)
+        )
 
-        self.entities[ent_id] = entity
-        log('EntityManager', f'Existing entity added #{ent_id}', 'debug')
+        for component_type, data in entity.get('components', {}).items():
+            record.setComponent(component_type, data)
 
-    def replace(self, ent_id, entity):
-        self.entities[ent_id] = entity
+        if entity_type in self.type_columns.keys():
+            for component_type, data in self.type_columns[entity_type].items():  # noqa
+                record.setComponent(component_type, data)
+
+        log(
+            'EntityManager',
+            'Existing entity added #{id}',
+            'debug',
+            id=ent_id
+        )
+        return record
+
+    def removeEntity(self, ent_id):
+        self.store.remove(ent_id)
+
+    def hasEntity(self, ent_id):
+        return self.store.has(ent_id)
 
     def addComponent(self, entity_id, component_type, component_data):
-        self.entities[entity_id]['components'][component_type] = component_data
+        self.store.get(entity_id).setComponent(component_type, component_data)
 
     def getEntity(self, entity_id):
-        return self.entities[entity_id]
+        return self.store.get(entity_id)
 
     def loadEntity(self, e):
-        self.addExistingEntity(e)
+        return self.addExistingEntity(e)
+
+    # Replaces the entity dicts of a level with the records of the entities
+    #     that were loaded from them
+    def loadEntities(self, level):
+        if 'entities' in level.keys():
+            level['entities'] = [self.loadEntity(e) for e in level['entities']]
+
+    # Packs the entities in some rows of the store (or of a copy of it) into a
+    #     compact binary form, e.g. for saving. The fields in the store's
+    #     columns are packed a column at a time (see ComponentStore.packRows),
+    #     along with each entity's type and the index of its other components
+    #     in extras (or -1). Combat state isn't packed
+    def packEntities(self, rows, store=None):
+        store = store or self.store
+        types = array('H')
+        extra_indexes = array('i')
+
+        type_names = []
+        type_codes = {}
+        extras = []
+
+        for row in rows:
+            e = store.records[row]
+
+            if e.type not in type_codes.keys():
+                type_codes[e.type] = len(type_names)
+                type_names.append(e.type)
+
+            types.append(type_codes[e.type])
+
+            if e.components:
+                extra_indexes.append(len(extras))
+                extras.append(e.components)
+            else:
+                extra_indexes.append(-1)
+
+        return {
+            'count': len(rows),
+            'types': type_names,
+            'movements': list(store.movement_types),
+            'extras': extras,
+            'data': (
+                types.tobytes() +
+                extra_indexes.tobytes() +
+                store.packRows(rows)
+            )
+        }
+
+    # Adds the entities packed by packEntities, and returns their records
+    def unpackEntities(self, packed):
+        store = self.store
+        count = packed['count']
+        data = packed['data']
+
+        types = array('H')
+        extra_indexes = array('i')
 
-        # Load entity data from pre-defined entity types
-        if 'type' in e.keys():
-            a = e['type'].split('.')[0]
-            b = e['type'].split('.')[1]
+        types_end = types.itemsize * count
+        extras_end = types_end + extra_indexes.itemsize * count
 
-            e['components'].update(
-                self.entity_types[a][b]['components']
+        types.frombytes(data[:types_end])
+        extra_indexes.frombytes(data[types_end:extras_end])
+
+        records = []
+        rows = []
+
+        for type_code, extra in zip(types, extra_indexes):
+            entity_type = packed['types'][type_code]
+
+            record = store.add(
+                self.id,
+                entity_type,
+                self.type_bases.get(entity_type)
             )
 
-    def loadEntities(self, level):
-        if 'entities' in level.keys():
-            for e in level['entities']:
-                self.loadEntity(e)
+            self.id += 1
 
-    # Like loadEntities, but only handles entities with a certain flag
-    def loadNewEntities(self, level):
-        if 'entities' in level.keys():
-            for e in level['entities']:
-                if 'new' in e.keys() and e['new']:
-                    self.loadEntity(e)
-                    e['new'] = False
-
-    def entityMakeMove(self, entity_id, level_id, world_manager, combat_manager):  # noqa
-        e = self.entities[entity_id]
-
-        if e['components']['movement'] == 'random':
-            x = e['components']['position']['x']
-            y = e['components']['position']['y']
-
-            adjacent_spots = [
-                {'x': x - 1, 'y': y - 1},
-                {'x': x, 'y': y - 1},
-                {'x': x + 1, 'y': y - 1},
-                {'x': x - 1, 'y': y},
-                {'x': x + 1, 'y': y},
-                {'x': x - 1, 'y': y + 1},
-                {'x': x, 'y': y + 1},
-                {'x': x + 1, 'y': y + 1}
-            ]
-
-            possible_spots = []
-
-            for a in adjacent_spots:
-                res = world_manager.validMove(level_id, a)
-
-                if res['success'] or res['message'] == 'player':
-                    possible_spots.append(a)
-
-                    if res['message'] == 'player':
-                        a['attack'] = True
-                        a['data'] = res['data']
-
-            res = random.randint(0, len(possible_spots) - 1)
-
-            if 'attack' in possible_spots[res].keys():
-                # The entity has attacked a player
-                combat_manager.attack(e, possible_spots[res]['data'])
-            else:
-                e['components']['position'] = possible_spots[res]
-                e['updated'] = True
+            if extra != -1:
+                components = packed['extras'][extra]
+
+                for component_type, component_data in components.items():
+                    record.setComponent(component_type, component_data)
+
+            records.append(record)
+            rows.append(record.row)
+
+        store.unpackRows(rows, data[extras_end:], packed['movements'])
+
+        log(
+            'EntityManager',
+            'Unpacked {count} entities',
+            'debug',
+            count=count
+        )
+
+        return records
 
     # If a player is in combat, tell their opponent(s) that they can make a
     #     move
     def playerInCombatMoved(self, sid, level, world_manager, combat_manager):
-        if 'entities' in level.keys():
-            for e in level['entities']:
-                try:
-                    if e['combat']['opponent'] == sid:
-                        self.entityMakeMove(e['id'], level['id'], world_manager, combat_manager)  # noqa
-                except KeyError:
-                    pass
+        store = self.store
+        mask = store.POSITION | store.MOVEMENT
+
+        rows = [
+            row for row in store.query(level['id'], mask)
+            if store.records[row].combat and
+            store.records[row].combat.get('opponent') == sid
+        ]
+
+        world_manager.moveMonsters(level['id'], rows, self, combat_manager)
@@ -0,0 +1,170 @@
+from log import log
+
+from . import Handlers
+from . import Shards
+
+import multiprocessing
+import queue
+import time
+
+import socketio
+
+
+# Lets client connections be spread across several socket.io server
+#     processes (front-ends), so that connections and encoding messages for
+#     them aren't limited to one core.
+# The game world runs in a process of its own. Front-ends pass the events
+#     their clients send to it, and anything that is emitted (by the world or
+#     a front-end) is published to every front-end, each of which sends it on
+#     to whichever of its own clients it's meant for.
+# Front-ends and the world talk through a MessageBus. The queues it uses can
+#     be multiprocessing queues (between processes) or queue.Queue (within
+#     one process, e.g. for testing)
+
+
+# The queues that front-ends and the world talk through
+class MessageBus:
+    def __init__(self, frontends, make_queue=multiprocessing.Queue):
+        # Events sent by clients, for the world to handle
+        self.events = make_queue()
+
+        # Messages to be carried out by each front-end
+        self.queues = [make_queue() for i in range(0, frontends)]
+
+    # Sends a message to every front-end
+    def publish(self, message):
+        for frontend_queue in self.queues:
+            frontend_queue.put(message)
+
+    # The same as publish, so that the bus can be used as the outbox of a
+    #     Shards.QueueSio
+    def put(self, message):
+        self.publish(message)
+
+
+# A socket.io client manager for front-ends, which shares emits with the other
+#     front-ends through a MessageBus.
+# As well as the messages that socketio.PubSubManager publishes, front-ends
+#     carry out the messages of Shards.QueueSio: emits, and putting players
+#     into rooms (which only the front-end that the player is connected to
+#     does)
+class QueueManager(socketio.PubSubManager):
+    name = 'queue'
+
+    def __init__(self, bus, index, channel='socketio', write_only=False):
+        super().__init__(channel=channel, write_only=write_only)
+
+        self.bus = bus
+        self.index = index
+
+    def _publish(self, data):
+        self.bus.publish(data)
+
+    def _listen(self):
+        frontend_queue = self.bus.queues[self.index]
+
+        while True:
+            try:
+                message = frontend_queue.get_nowait()
+            except queue.Empty:
+                self.server.sleep(0.005)
+                continue
+
+            # Messages published by socketio.PubSubManager
+            if isinstance(message, dict):
+                yield message
+                continue
+
+            message_type = message[0]
+
+            if message_type == 'emit':
+                event, data, room = message[1:]
+
+                yield {
+                    'method': 'emit',
+                    'event': event,
+                    'data': data,
+                    'namespace': '/',
+                    'room': room
+                }
+
+            elif message_type in ['enter room', 'leave room']:
+                sid, room = message[1:]
+
+                # The player is connected to another front-end
+                if not self.is_connected(sid, '/'):
+                    continue
+
+                if message_type == 'enter room':
+                    self.enter_room(sid, '/', room)
+                else:
+                    self.leave_room(sid, '/', room)
+
+
+# Passes the events that a front-end's clients send to the world. Has the
+#     same methods as Handlers
+class EventForwarder:
+    def __init__(self, bus):
+        self.bus = bus
+
+    def login(self, sid, username):
+        self.bus.events.put(('login', sid, username))
+
+    def disconnect(self, sid):
+        self.bus.events.put(('disconnect', sid))
+
+    def requestPresentLevel(self, sid, held=None):
+        self.bus.events.put(('request present level', sid, held))
+
+    def action(self, sid, action_type, details):
+        self.bus.events.put(('action', sid, action_type, details))
+
+    def requestStats(self, sid):
+        self.bus.events.put(('request stats', sid))
+
+
+# The entry point of the world process. The world is run by one worker, or
+#     split between several by a Shards.ShardRouter.
+# The world can be saved to a snapshot directory (see Snapshots) when it's
+#     run by one worker
+def runWorld(bus, workers, default_level, tick_rate, snapshot_directory=None,
+             snapshot_interval=60, move_rate=10):
+    if workers <= 1:
+        Shards.ShardWorker(
+            0,
+            bus.events,
+            bus,
+            tick_rate,
+            False,
+            snapshot_directory,
+            snapshot_interval,
+            move_rate
+        ).run()
+
+        return
+
+    router = Shards.ShardRouter(
+        Shards.QueueSio(bus),
+        workers,
+        default_level,
+        tick_rate,
+        move_rate
+    )
+
+    router.start()
+    log('FrontEnds', f'World started with {workers} workers')
+
+    while True:
+        handled = router.relay()
+
+        while True:
+            try:
+                event = bus.events.get_nowait()
+            except queue.Empty:
+                break
+
+            Handlers.dispatch(router, event)
+            handled += 1
+
+        if not handled:
+            time.sleep(0.005)
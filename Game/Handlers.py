@@ -0,0 +1,125 @@
+from log import log
+
+
+# Handles the events that clients send, for a game world run by a Manager.
+# sio is what events are sent with: a socketio.Server, or anything with the
+#     same emit, enter_room and leave_room methods (e.g. Shards.QueueSio)
+class Handlers:
+    def __init__(self, manager, sio, scheduler=None):
+        self.manager = manager
+        self.sio = sio
+        self.scheduler = scheduler
+
+    # A user has logged in.
+    # components are used for players that already have an entity (e.g.
+    #     coming from another process), and level_id for those that aren't
+    #     starting at the default level
+    def login(self, sid, username, level_id=None, components=None):
+        self.manager.addPlayer(sid, username, level_id, components)
+        self.manager.emitUpdates(self.sio)
+
+    def disconnect(self, sid):
+        self.manager.removePlayer(sid)
+        self.manager.emitUpdates(self.sio)
+
+    # A user has requested the data of the level they're on.
+    # After they're sent the level, they'll want to recieve updates for
+    #     anything that happens on the level, so they need to be "linked"
+    #     with the level as well.
+    # Clients can send the versions of the levels that they have the tiles of
+    #     (level ID -> version), so that those aren't sent again
+    def requestPresentLevel(self, sid, held=None):
+        level = self.manager.getPresentLevel(sid)
+
+        if not level:
+            return
+
+        public_level = self.manager.getPublicLevel(sid, held)
+
+        # Send the level to the client
+        self.sio.emit('present level', public_level, room=sid)
+
+        # Then its tiles, a chunk at a time, unless the client has them
+        if not public_level['transfer']['cached']:
+            transfer = self.manager.WorldManager.getLevelTransfer(level['id'])
+
+            for chunk in transfer['chunks']:
+                self.sio.emit('level chunk', chunk, room=sid)
+
+        self.sio.emit('msg', 'Moved to level ' + level['title'], room=sid)
+
+        self.manager.linkPlayerToLevel(sid, level['id'])
+
+        log(
+            'Handlers',
+            'Sent level {level_id} to {username}',
+            'debug',
+            level_id=level['id'],
+            username=self.manager.players[sid]['username']
+        )
+
+    # Handles a user action
+    def action(self, sid, action_type, details):
+        self.handleAction(sid, action_type, details)
+
+        # Emit any changes that the action might have caused
+        self.manager.emitUpdates(self.sio)
+
+    # Handles a batch of user actions, as (SID, action type, details), and
+    #     emits the changes they caused once, after all of them (see
+    #     InputQueue)
+    def actions(self, batch):
+        for sid, action_type, details in batch:
+            self.handleAction(sid, action_type, details)
+
+        self.manager.emitUpdates(self.sio)
+
+    # Carries out an action, and sends the player its response
+    def handleAction(self, sid, action_type, details):
+        response = self.manager.action(sid, action_type, details)
+
+        if response:
+            if response['response'] == 'message':
+                self.sio.emit('msg', response['data'], room=sid)
+
+            elif response['response'] == 'level change':
+                self.sio.emit('level change', room=sid)
+
+                log(
+                    'Handlers',
+                    'User {username} -> Level {level_id}',
+                    'debug',
+                    username=self.manager.players[sid]['username'],
+                    level_id=response['data']
+                )
+
+    # Sends statistics about how long server ticks are taking
+    def requestStats(self, sid):
+        if self.scheduler:
+            self.sio.emit('stats', self.scheduler.stats(), room=sid)
+
+
+# Passes an event sent between processes to the matching method of a handler
+#     (Handlers, or anything with the same methods, e.g. Shards.ShardRouter).
+#     Events are tuples of the event type and the method's arguments, e.g.
+#     ('action', sid, action_type, details). Returns False if the event type
+#     isn't known
+def dispatch(handlers, event):
+    event_type = event[0]
+
+    if event_type == 'login':
+        handlers.login(*event[1:])
+    elif event_type == 'disconnect':
+        handlers.disconnect(*event[1:])
+    elif event_type == 'request present level':
+        handlers.requestPresentLevel(*event[1:])
+    elif event_type == 'action':
+        handlers.action(*event[1:])
+    elif event_type == 'actions':
+        handlers.actions(*event[1:])
+    elif event_type == 'request stats':
+        handlers.requestStats(*event[1:])
+    else:
+        return False
+
+    return True
@@ -0,0 +1,104 @@
+import collections
+import time
+
+
+# Queues up the actions that players send, and handles them in rounds (see
+#     process) instead of as they arrive, passing each round to a handler
+#     (e.g. Handlers.Handlers) as one batch. Has the same methods as
+#     Handlers. Other events are passed straight on.
+# Clients send a move for every key press, including key repeats, so without
+#     this one player holding a key can make the server handle (and emit the
+#     changes of) hundreds of moves a second. Here, each player moves at most
+#     once a round, and moves that are sent before the last one has been
+#     handled replace it, so running rounds at a fixed rate limits how fast
+#     players can move, and how much work they can make, however fast they
+#     send moves.
+# Inputs that have waited longer than max_age (e.g. because the server fell
+#     behind) are dropped, rather than being carried out late
+class InputQueue:
+    def __init__(self, handlers, max_inputs=8, max_age=1,
+                 clock=time.monotonic):
+        self.handlers = handlers
+
+        self.max_inputs = max_inputs  # Per player, at a time
+        self.max_age = max_age  # Seconds
+        self.clock = clock
+
+        # SID -> deque of inputs, as (time received, action type, details)
+        self.inputs = {}
+
+        # Inputs that weren't handled
+        self.coalesced = 0  # Moves that were replaced by a later move
+        self.dropped = 0  # Inputs that didn't fit in the queue
+        self.stale = 0  # Inputs that waited too long
+
+    def login(self, sid, username, level_id=None, components=None):
+        self.handlers.login(sid, username, level_id, components)
+
+    def disconnect(self, sid):
+        self.inputs.pop(sid, None)
+        self.handlers.disconnect(sid)
+
+    def requestPresentLevel(self, sid, held=None):
+        self.handlers.requestPresentLevel(sid, held)
+
+    def action(self, sid, action_type, details):
+        if sid not in self.inputs.keys():
+            self.inputs[sid] = collections.deque()
+
+        inputs = self.inputs[sid]
+        received = self.clock()
+
+        if action_type == 'move' and inputs and inputs[-1][1] == 'move':
+            inputs[-1] = (received, action_type, details)
+            self.coalesced += 1
+        elif len(inputs) < self.max_inputs:
+            inputs.append((received, action_type, details))
+        else:
+            self.dropped += 1
+
+    def requestStats(self, sid):
+        self.handlers.requestStats(sid)
+
+    # Handles a round of inputs: everything that each player has sent since
+    #     the last round, up to their next move after the first. Meant to be
+    #     run at a fixed rate, e.g. by a scheduler
+    def process(self):
+        now = self.clock()
+        batch = []
+
+        for sid, inputs in list(self.inputs.items()):
+            moved = False
+
+            while inputs:
+                received, action_type, details = inputs[0]
+
+                if now - received > self.max_age:
+                    inputs.popleft()
+                    self.stale += 1
+                    continue
+
+                if action_type == 'move':
+                    # The next move waits for the next round
+                    if moved:
+                        break
+
+                    moved = True
+
+                inputs.popleft()
+                batch.append((sid, action_type, details))
+
+            if not inputs:
+                del self.inputs[sid]
+
+        if batch:
+            self.handlers.actions(batch)
+
+    # Returns how many inputs are waiting, and how many weren't handled
+    def stats(self):
+        return {
+            'queued': sum(len(inputs) for inputs in self.inputs.values()),
+            'coalesced': self.coalesced,
+            'dropped': self.dropped,
+            'stale': self.stale
+        }
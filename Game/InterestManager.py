@@ -0,0 +1,65 @@
+import math
+
+
+# Keeps track of which entities each player can see, so that players on
+#     large levels are only sent entities that are near them.
+# Players see the square of tiles within a view radius of them. The radius
+#     comes from how many tiles fit on a screen at the level's zoom, so levels
+#     that fit on a screen don't need any of this, and everything on them is
+#     sent to everyone
+class InterestManager:
+    def __init__(self):
+        # The size of the screens that players are assumed to have, in
+        #     pixels. Players with bigger screens might see entities pop in
+        #     near the edges
+        self.view_width = 1280
+        self.view_height = 720
+
+        # Extra tiles around the edge of the screen, so that entities are
+        #     sent a little before they come into view
+        self.margin = 2
+
+        # What each player was last sent. SID -> {'level', 'ids': set}
+        self.views = {}
+
+    # Returns how far (in tiles) players on a level can see, or None if the
+    #     whole level fits on a screen
+    def viewRadius(self, level):
+        zoom = level['level'].get('camera_zoom', 1)
+
+        tiles_across = self.view_width / (level['level']['tile_width'] * zoom)
+        tiles_down = self.view_height / (level['level']['tile_height'] * zoom)
+
+        radius = math.ceil(max(tiles_across, tiles_down) / 2) + self.margin
+
+        if radius * 2 + 1 >= max(level['level']['width'], level['level']['height']):  # noqa
+            return None
+
+        return radius
+
+    # Sets the entities that a player has been sent on a level
+    def setView(self, sid, level_id, ids):
+        self.views[sid] = {
+            'level': level_id,
+            'ids': set(ids)
+        }
+
+    # Updates the entities that a player can see. Returns the IDs of entities
+    #     that came into view and those that left it
+    def updateView(self, sid, level_id, ids):
+        ids = set(ids)
+        view = self.views.get(sid)
+
+        if not view or view['level'] != level_id:
+            self.setView(sid, level_id, ids)
+            return ids, set()
+
+        entered = ids - view['ids']
+        left = view['ids'] - ids
+
+        view['ids'] = ids
+
+        return entered, left
+
+    def forget(self, sid):
+        self.views.pop(sid, None)
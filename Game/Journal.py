@@ -0,0 +1,277 @@
+from log import log
+
+from . import Handlers
+from . import Manager
+
+import atexit
+import collections
+import hashlib
+import json
+import struct
+import threading
+import time
+
+
+# Records everything that reaches the world from outside: the events that
+#     players send, and when each tick starts. Along with the seed that the
+#     world was made with (see Manager), that's enough to run the world again
+#     exactly the same way (see Replay), as fast as it can go. This gives
+#     benchmarks real traffic to run, and a way to check that a change
+#     doesn't change what happens in the world.
+# The world has to start from scratch for a replay to match, so a world
+#     restored from a snapshot shouldn't be journaled.
+# Records are kept in memory, and written in batches by a background thread.
+#     Journal files start with the magic, the file version and the length of
+#     a JSON header ({'seed', 'start'}) followed by the header, and then have
+#     a record after another: its type, the length of its data, and its data
+#     as JSON
+class Journal:
+    magic = b'PTJL'
+    file_version = 1
+
+    file_header = struct.Struct('<4sHI')
+    record_header = struct.Struct('<BI')
+
+    # Record types
+    TICK = 0  # Data is the time of the tick
+    EVENT = 1  # Data is an event, as passed to Handlers.dispatch
+
+    def __init__(self, path, seed, interval=1):
+        self.path = path
+        self.seed = seed
+        self.interval = interval  # Seconds between writes
+
+        # The time on the world's clock. It only moves on at the start of
+        #     each tick, so that a replay can give the world the same times
+        self.now = time.monotonic()
+
+        # Appended to by the game thread, and emptied by the writer thread
+        self.records = collections.deque()
+        self.lock = threading.Lock()  # Held while writing
+
+        header = json.dumps({
+            'seed': seed,
+            'start': self.now
+        }).encode()
+
+        with open(path, 'wb') as f:
+            f.write(self.file_header.pack(
+                self.magic,
+                self.file_version,
+                len(header)
+            ))
+
+            f.write(header)
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+        atexit.register(self.flush)
+
+    # Used as the world's clock (see WorldManager)
+    def clock(self):
+        return self.now
+
+    # Marks the start of a tick. Meant to be run as the first phase of a
+    #     scheduler
+    def tick(self):
+        self.now = time.monotonic()
+        self.records.append((self.TICK, self.now))
+
+    def record(self, event):
+        self.records.append((self.EVENT, event))
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    # Writes the records that have been made since the last write
+    def flush(self):
+        with self.lock:
+            data = bytearray()
+
+            while True:
+                try:
+                    record_type, record = self.records.popleft()
+                except IndexError:
+                    break
+
+                encoded = json.dumps(record).encode()
+
+                data += self.record_header.pack(record_type, len(encoded))
+                data += encoded
+
+            if not data:
+                return
+
+            try:
+                with open(self.path, 'ab') as f:
+                    f.write(data)
+            except OSError as e:
+                log(
+                    'Journal',
+                    'Failed to write {path}: {error}',
+                    'error',
+                    path=self.path,
+                    error=e
+                )
+
+
+# Reads a journal file. Returns its header and a list of its records, as
+#     (type, data)
+def read(path):
+    with open(path, 'rb') as f:
+        contents = f.read()
+
+    magic, file_version, length = Journal.file_header.unpack_from(contents)
+
+    if magic != Journal.magic or file_version != Journal.file_version:
+        raise ValueError(f'{path} isn\'t a journal file')
+
+    offset = Journal.file_header.size
+    header = json.loads(contents[offset:offset + length])
+    offset += length
+
+    records = []
+
+    # A journal that was being written when its server stopped can end part
+    #     of the way through a record
+    while offset + Journal.record_header.size <= len(contents):
+        record_type, length = Journal.record_header.unpack_from(
+            contents,
+            offset
+        )
+
+        offset += Journal.record_header.size
+
+        if offset + length > len(contents):
+            break
+
+        records.append((record_type, json.loads(contents[offset:offset + length])))  # noqa
+        offset += length
+
+    return header, records
+
+
+# Passes events on to a handler (e.g. Handlers.Handlers), recording them in a
+#     journal first. Has the same methods as Handlers
+class Recorder:
+    def __init__(self, handlers, journal):
+        self.handlers = handlers
+        self.journal = journal
+
+    def handle(self, *event):
+        self.journal.record(event)
+        Handlers.dispatch(self.handlers, event)
+
+    def login(self, sid, username, level_id=None, components=None):
+        self.handle('login', sid, username, level_id, components)
+
+    def disconnect(self, sid):
+        self.handle('disconnect', sid)
+
+    def requestPresentLevel(self, sid, held=None):
+        self.handle('request present level', sid, held)
+
+    def action(self, sid, action_type, details):
+        self.handle('action', sid, action_type, details)
+
+    def actions(self, batch):
+        self.handle('actions', batch)
+
+    def requestStats(self, sid):
+        self.handle('request stats', sid)
+
+
+# Stands in for a socketio.Server during a replay. Emits are only counted
+class NullSio:
+    def __init__(self):
+        self.emits = {}  # Event -> how many times it was emitted
+
+    def emit(self, event, data=None, room=None):
+        self.emits[event] = self.emits.get(event, 0) + 1
+
+    def enter_room(self, sid, room):
+        pass
+
+    def leave_room(self, sid, room):
+        pass
+
+
+# Runs a journal again against a new world, without waiting between ticks
+class Replay:
+    def __init__(self, path):
+        self.header, self.records = read(path)
+
+        self.manager = Manager.Manager(self.header['seed'])
+        self.now = self.header['start']
+        self.manager.WorldManager.clock = self.clock
+
+        self.sio = NullSio()
+        self.handlers = Handlers.Handlers(self.manager, self.sio)
+
+        # The same as the phases that servers run each tick
+        self.phases = [
+            self.manager.updateSpawns,
+            self.manager.updateAI,
+            self.manager.updateCombat,
+            self.manager.updateEviction,
+            lambda: self.manager.emitUpdates(self.sio)
+        ]
+
+    def clock(self):
+        return self.now
+
+    # Runs the whole journal. Returns how long it took, and how long each
+    #     tick took (in seconds)
+    def run(self):
+        tick_durations = []
+        events = 0
+
+        start = time.perf_counter()
+
+        for record_type, record in self.records:
+            if record_type == Journal.TICK:
+                self.now = record
+                tick_start = time.perf_counter()
+
+                for phase in self.phases:
+                    phase()
+
+                tick_durations.append(time.perf_counter() - tick_start)
+            else:
+                Handlers.dispatch(self.handlers, record)
+                events += 1
+
+        return {
+            'seconds': time.perf_counter() - start,
+            'ticks': len(tick_durations),
+            'events': events,
+            'tick_durations': tick_durations,
+            'emits': dict(self.sio.emits)
+        }
+
+    # Returns a hash of the state of the world, which is the same for every
+    #     replay of a journal
+    def digest(self):
+        return digest(self.manager)
+
+
+# Returns a hash of the state of a world: its levels, and the entities on
+#     them
+def digest(manager):
+    world_manager = manager.WorldManager
+    state = hashlib.sha1()
+
+    for level_id in sorted(world_manager.levels.keys()):
+        state.update(level_id.encode())
+        state.update(world_manager.grids[level_id]['version'].encode())
+
+        for e in world_manager.levels[level_id].get('entities', []):
+            state.update(json.dumps(
+                [e.id, e.active, e.getComponents()],
+                sort_keys=True
+            ).encode())
+
+    return state.hexdigest()
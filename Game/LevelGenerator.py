@@ -0,0 +1,291 @@
+from log import log
+
+from array import array
+import random
+
+
+# Generates the tiles of procedural levels.
+# Generators are chosen by the "generator" key of a level, and can be added
+#     with addGenerator. Each is given the level, the tileset it uses and a
+#     seeded random number generator, and returns the level's tiles (as a grid
+#     of tileset codes) and a spawn point. The same seed always gives the same
+#     level
+class LevelGenerator:
+    def __init__(self, rng=None):
+        # Used to pick seeds for levels that don't have one
+        self.rng = rng or random.Random()
+
+        self.generators = {
+            'cave': self.generateCave,
+            'cave walk': self.generateCaveWalk
+        }
+
+    def addGenerator(self, name, generator):
+        self.generators[name] = generator
+
+    # Generates a level's tiles. If the level doesn't specify a seed, a random
+    #     one is picked and stored in the level, so it can be made again.
+    # Returns {'tiles': grid of codes, 'spawn': {'x', 'y'}}, or None if the
+    #     level's generator doesn't exist
+    def generate(self, level, tileset):
+        name = level['level']['generator']
+
+        if name not in self.generators.keys():
+            log('LevelGenerator', f'Unknown generator {name}', 'error')
+            return None
+
+        if 'seed' not in level['level'].keys():
+            level['level']['seed'] = self.rng.getrandbits(32)
+
+        rng = random.Random(level['level']['seed'])
+
+        return self.generators[name](level, tileset, rng)
+
+    # Caves made with a cellular automaton. The map starts as random noise,
+    #     and is smoothed by turning each tile into whatever most of the tiles
+    #     around it are. Only the cave connected to the middle of the map is
+    #     kept, so that all of it can be reached.
+    # The whole map is handled at once, as bits in Python integers, so the
+    #     time taken grows linearly with the size of the map
+    def generateCave(self, level, tileset, rng):
+        w = level['level']['width']
+        h = level['level']['height']
+
+        wall_chance = level['level'].get('wall_chance', 0.45)
+        smoothing = level['level'].get('smoothing', 4)
+
+        # Each tile is one bit. The map is padded by a border of one tile, so
+        #     that shifting bits left or right doesn't wrap from one row to
+        #     the next. Bit (y + 1) * stride + (x + 1) is tile (x, y)
+        stride = w + 2
+        n = stride * (h + 2)
+
+        border_row = '0' * stride
+        inner_row = '0' + '1' * w + '0'
+        inner = self.fromString(border_row + inner_row * h + border_row)
+
+        # Fill the map with random walls
+        noise = self.randomBits(rng, n, wall_chance)
+        walls = (noise & inner) | (~inner & ((1 << n) - 1))
+
+        for i in range(0, smoothing):
+            walls = self.smooth(walls, inner, stride, n)
+
+        floor = ~walls & inner
+
+        # Keep the largest connected area found, starting from the tile
+        #     closest to the middle of the map
+        floor_string = self.toString(floor, n)
+        total_floor = floor_string.count('1')
+        middle = (h // 2 + 1) * stride + (w // 2 + 1)
+
+        cave = 0
+        cave_size = 0
+
+        for attempt in range(0, 4):
+            if attempt == 0:
+                start = self.nearestSetBit(floor_string, middle)
+            else:
+                start = self.nearestSetBit(floor_string, rng.randrange(0, n))
+
+            if start is None:
+                break
+
+            region = self.floodFill(1 << start, floor, stride, n)
+            region_size = bin(region).count('1')
+
+            if region_size > cave_size:
+                cave = region
+                cave_size = region_size
+
+            # Good enough if it's most of the floor
+            if cave_size * 2 >= total_floor:
+                break
+
+        if not cave:
+            # Nothing but walls, so at least make room to stand
+            cave = 1 << middle
+
+        # Walls around the cave, and tall grass here and there
+        walls = self.dilate(cave, stride, n) & inner & ~cave
+        grass = cave & self.randomBits(rng, n, 1 / 3)
+        ground = cave & ~grass
+
+        empty_code = tileset['empty']
+
+        layers = [
+            (ground, tileset['ground']),
+            (grass, tileset.get('tall grass', tileset['ground'])),
+            (walls, tileset.get('wall', empty_code))
+        ]
+
+        tiles = self.toCodes(layers, empty_code, w, h, stride, n)
+
+        # Spawn somewhere random in the cave
+        cave_string = self.toString(cave, n)
+        spawn = self.nearestSetBit(cave_string, rng.randrange(0, n))
+
+        return {
+            'tiles': tiles,
+            'spawn': {
+                'x': spawn % stride - 1,
+                'y': spawn // stride - 1
+            }
+        }
+
+    # Caves made by wandering around at random, placing floor along the way.
+    # Slow for large maps, since finding the last few empty tiles to fill
+    #     takes a long time
+    def generateCaveWalk(self, level, tileset, rng):
+        w = level['level']['width']
+        h = level['level']['height']
+
+        total_tiles = w * h
+        fill_tiles = int(total_tiles / 3)  # How many tiles to generate
+
+        # Start in the middle of the level space
+        cur_x = int(w / 2)
+        cur_y = int(h / 2)
+
+        # Tiles that are allowed to be generated.
+        # Multiple entries are used as a simple weighting system for now
+        possible_tiles = [
+            tileset['ground'],
+            tileset['ground'],
+            tileset.get('tall grass', tileset['ground'])
+        ]
+
+        empty_code = tileset['empty']
+        tiles = array('B', [empty_code]) * total_tiles
+
+        # Tiles where a spawn point could be placed
+        spawnable_tiles = []
+
+        # Randomly create a floor space using a random walk algorithm
+        for i in range(0, fill_tiles):
+            tiles[cur_y * w + cur_x] = rng.choice(possible_tiles)
+
+            spawnable_tiles.append({
+                'x': cur_x,
+                'y': cur_y
+            })
+
+            # Move the "cursor" randomly until a suitable next spot to place a
+            #     tile is found. The cursor stays within the level
+            while tiles[cur_y * w + cur_x] != empty_code:
+                direction = rng.randrange(0, 4)
+
+                if direction == 0:
+                    cur_x = min(cur_x + 1, w - 1)
+                elif direction == 1:
+                    cur_x = max(cur_x - 1, 0)
+                elif direction == 2:
+                    cur_y = min(cur_y + 1, h - 1)
+                else:
+                    cur_y = max(cur_y - 1, 0)
+
+        return {
+            'tiles': tiles,
+            'spawn': rng.choice(spawnable_tiles)
+        }
+
+    # Helpers for handling maps as bits.
+    # Bit i of an integer is tile i. Strings of bits are written with tile 0
+    #     first, which is the reverse of how Python writes integers
+    def fromString(self, bit_string):
+        return int(bit_string[::-1], 2)
+
+    def toString(self, bits, n):
+        return format(bits, f'0{n}b')[::-1]
+
+    # Returns n random bits, each set with the given chance
+    def randomBits(self, rng, n, chance):
+        threshold = int(chance * 256)
+        table = bytes(
+            [ord('1') if i < threshold else ord('0') for i in range(0, 256)]
+        )
+
+        noise = rng.getrandbits(n * 8).to_bytes(n, 'little').translate(table)
+        return self.fromString(noise)
+
+    # Returns the index of the set bit in a string of bits that comes first
+    #     at or after the given index, wrapping around to the start
+    def nearestSetBit(self, bit_string, index):
+        found = bit_string.find('1', index)
+
+        if found == -1:
+            found = bit_string.find('1')
+
+        if found == -1:
+            return None
+
+        return found
+
+    # Spreads set bits to the 8 tiles around them
+    def dilate(self, bits, stride, n):
+        mask = (1 << n) - 1
+
+        bits = bits | (bits << 1) | (bits >> 1)
+        bits = bits | (bits << stride) | (bits >> stride)
+
+        return bits & mask
+
+    # Grows a set of bits to everything connected to it within an area
+    def floodFill(self, bits, area, stride, n):
+        while True:
+            grown = self.dilate(bits, stride, n) & area
+
+            if grown == bits:
+                return bits
+
+            bits = grown
+
+    # One step of the cellular automaton. A tile becomes a wall when at least
+    #     5 of the 9 tiles around it (including itself) are walls.
+    # The 9 neighbour counts are added up all at once with bitwise adders,
+    #     keeping each bit of the count in its own integer
+    def smooth(self, walls, inner, stride, n):
+        mask = (1 << n) - 1
+        count = [0, 0, 0, 0]  # Bits of the count, lowest first
+
+        for offset in [
+            -stride - 1, -stride, -stride + 1,
+            -1, 0, 1,
+            stride - 1, stride, stride + 1
+        ]:
+            if offset > 0:
+                carry = walls >> offset
+            else:
+                carry = (walls << -offset) & mask
+
+            for i in range(0, len(count)):
+                count[i], carry = count[i] ^ carry, count[i] & carry
+
+        at_least_5 = count[3] | (count[2] & (count[1] | count[0]))
+
+        return (at_least_5 & inner) | (~inner & mask)
+
+    # Converts layers of bits into a grid of tileset codes, without padding.
+    # Each layer is a (bits, code) pair, and layers shouldn't overlap
+    def toCodes(self, layers, empty_code, w, h, stride, n):
+        # Spread each bit out to a byte, so that multiplying by a code puts
+        #     that code in every set tile
+        spread = bytes.maketrans(b'01', b'\x00\x01')
+        codes = 0
+        covered = 0
+
+        for bits, code in layers:
+            covered |= bits
+            layer = self.toString(bits, n).encode().translate(spread)
+            codes += int.from_bytes(layer, 'little') * code
+
+        uncovered = ~covered & ((1 << n) - 1)
+        layer = self.toString(uncovered, n).encode().translate(spread)
+        codes += int.from_bytes(layer, 'little') * empty_code
+
+        padded = codes.to_bytes(n, 'little')
+
+        return array('B', b''.join(
+            padded[(y + 1) * stride + 1:(y + 1) * stride + 1 + w]
+            for y in range(0, h)
+        ))
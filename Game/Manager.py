@@ -3,14 +3,22 @@ from log import log
 from . import WorldManager
 from . import EntityManager
 from . import CombatManager
+from . import InterestManager
+
+import random
 
 
 # Manages the entire game world
 class Manager:
-    def __init__(self):
-        self.WorldManager = WorldManager.WorldManager()
+    # The world can be given a seed, so that it can be run again the same way
+    #     (see Journal)
+    def __init__(self, seed=None):
+        self.rng = random.Random(seed)
+
+        self.WorldManager = WorldManager.WorldManager(self.rng)
         self.EntityManager = EntityManager.EntityManager()
         self.CombatManager = CombatManager.CombatManager()
+        self.InterestManager = InterestManager.InterestManager()
 
         self.players = {}
         self.links = {}  # Links from levels to players to be updated
@@ -18,7 +26,38 @@ class Manager:
         # A list of entity IDs that clients need to destroy
         self.entities_to_destroy = []
 
-    def addPlayer(self, sid, username):
+        # The socket.io rooms that players have been put in, which should
+        #     match the links. Level ID -> set of SIDs
+        self.rooms = {}
+
+        # Players to be taken out of the rooms of levels that have been
+        #     unloaded, as (SID, room)
+        self.rooms_to_leave = []
+
+        # When set, players who go down stairs are handed to this instead of
+        #     being moved to the next level here, e.g. because another
+        #     process runs that level.
+        # Called with (SID, username, target level ID, components)
+        self.handoff = None
+
+        # Players who were online when the world was last saved, and haven't
+        #     come back since it was restored (see Snapshots). Username ->
+        #     {'level', 'components'}
+        self.saved_players = {}
+
+    # Adds a player to the world, on the default level unless a level is
+    #     given. Players who already have an entity somewhere else (e.g. in
+    #     another process) can bring its components with them
+    def addPlayer(self, sid, username, level_id=None, components=None):
+        # Players who were online when the world was saved carry on from
+        #     where they were
+        if components is None and username in self.saved_players.keys():
+            saved = self.saved_players.pop(username)
+
+            if saved['level'] in self.WorldManager.defined_levels.keys():
+                level_id = saved['level']
+                components = saved['components']
+
         # Create an entity for the player
         player_entity = self.EntityManager.addNew()
 
@@ -34,7 +73,7 @@ class Manager:
         # Finish setting up the player object
         self.players[sid] = {
             'username': username,
-            'on level': self.WorldManager.defaultLevel(),
+            'on level': level_id or self.WorldManager.defaultLevel(),
             'entity': player_entity
         }
 
@@ -67,6 +106,16 @@ class Manager:
             }
         )
 
+        # Players keep everything but where they were
+        if components:
+            for component_type, data in components.items():
+                if component_type not in ['position', 'sid']:
+                    self.EntityManager.addComponent(
+                        player_entity,
+                        component_type,
+                        data
+                    )
+
         # Add the player's entity to the level they're on
         if 'entities' not in present_level.keys():
             present_level['entities'] = []
@@ -74,19 +123,34 @@ class Manager:
         present_level['entities'].append(
             self.EntityManager.getEntity(player_entity))
 
+        self.WorldManager.placeEntity(
+            present_level['id'],
+            self.EntityManager.getEntity(player_entity)
+        )
+
     def removePlayer(self, sid):
         if sid in self.players.keys():
             ent = self.EntityManager.getEntity(self.players[sid]['entity'])
+            on_level = self.players[sid]['on level']
+
+            if self.WorldManager.levelLoaded(on_level):
+                self.WorldManager.unplaceEntity(on_level, ent)
 
-            ent['active'] = False
-            ent['updated'] = True
+            ent.active = False
+            ent.updated = True
+
+            self.unlinkPlayerFromLevel(sid, on_level)
+            self.InterestManager.forget(sid)
 
             log(
                 'Manager',
-                f'Player removed (entity #{self.players[sid]["entity"]})',
-                'debug'
+                'Player removed (entity #{entity})',
+                'debug',
+                entity=self.players[sid]['entity']
             )
 
+            del self.players[sid]
+
     # Given a player's SID, returns the level that they're on
     def getPresentLevel(self, sid):
         if sid in self.players.keys():
@@ -99,12 +163,14 @@ class Manager:
                 # If loading is a success, then return the level
                 log(
                     'Manager',
-                    f'Have to load level {on_level} for \
-{self.players[sid]["username"]}',
-                    'debug'
+                    'Have to load level {level_id} for {username}',
+                    'debug',
+                    level_id=on_level,
+                    username=self.players[sid]['username']
                 )
 
                 if self.WorldManager.loadLevel(on_level, self.EntityManager):
+                    self.updateLevelActivity(on_level)
                     return self.WorldManager.getLevel(on_level)
         else:
             # If the player isn't known, it's a warning
@@ -118,19 +184,32 @@ class Manager:
         else:
             self.links[level_id] = [sid]
 
+        self.updateLevelActivity(level_id)
+
     def unlinkPlayerFromLevel(self, sid, level_id):
         if level_id in self.links.keys():
             if sid in self.links[level_id]:
                 self.links[level_id].remove(sid)
 
+        self.updateLevelActivity(level_id)
+
+    # Levels with linked players are simulated, and levels without any are put
+    #     to sleep
+    def updateLevelActivity(self, level_id):
+        if not self.WorldManager.levelLoaded(level_id):
+            return
+
+        if self.links.get(level_id):
+            self.WorldManager.wakeLevel(level_id, self.EntityManager)
+        else:
+            self.WorldManager.sleepLevel(level_id)
+
     # Handles a user action
     def action(self, sid, action_type, details):
         if action_type == 'move':
             if sid in self.players.keys():
                 ent = self.EntityManager.getEntity(self.players[sid]['entity'])
-                pos = ent['components']['position']
-
-                new_pos = pos.copy()
+                new_pos = ent.getComponent('position')
 
                 if 'dir' in details.keys() and details['dir'] == '1':
                     new_pos['x'] -= 1
@@ -159,12 +238,11 @@ class Manager:
                 )
 
                 if response['success']:
-                    pos['x'] = new_pos['x']
-                    pos['y'] = new_pos['y']
-
-                    # Mark the entity as updated, so that it will be sent to
-                    #     users
-                    ent['updated'] = True
+                    self.WorldManager.moveEntity(
+                        self.players[sid]['on level'],
+                        ent,
+                        new_pos
+                    )
 
                     # Update combat stuff
                     self.WorldManager.checkForCombat(
@@ -172,7 +250,7 @@ class Manager:
                         ent
                     )
 
-                    if 'combat' in ent.keys() and ent['combat']['in_combat']:
+                    if ent.combat and ent.combat['in_combat']:
                         self.EntityManager.playerInCombatMoved(
                             sid,
                             self.getPresentLevel(sid),
@@ -190,13 +268,19 @@ class Manager:
                     if response['message'] == 'monster':
                         response['message'] = self.CombatManager.attack(ent, response['data'])  # noqa
 
+                        if not response['data'].active:
+                            self.WorldManager.unplaceEntity(
+                                self.players[sid]['on level'],
+                                response['data']
+                            )
+
                     # Update combat stuff
                     self.WorldManager.checkForCombat(
                         self.players[sid]['on level'],
                         ent
                     )
 
-                    if 'combat' in ent.keys() and ent['combat']['in_combat']:
+                    if ent.combat and ent.combat['in_combat']:
                         self.EntityManager.playerInCombatMoved(
                             sid,
                             self.getPresentLevel(sid),
@@ -220,97 +304,367 @@ class Manager:
 
                     # Remove the player's entity from its current level
                     for i in range(0, len(level['entities'])):
-                        if 'sid' in level['entities'][i]['components']:
-                            if level['entities'][i]['components']['sid']['sid'] == sid:  # noqa
+                        if level['entities'][i].hasComponent('sid'):
+                            if level['entities'][i].getComponent('sid')['sid'] == sid:  # noqa
                                 stairs_pos = self.WorldManager.getTilePos(on_level, 'stairs down')  # noqa
 
                                 # If the player isn't on stairs, ignore
-                                if stairs_pos != level['entities'][i]['components']['position']:  # noqa
+                                if stairs_pos != level['entities'][i].getComponent('position'):  # noqa
                                     return
 
                                 self.entities_to_destroy.append(
                                     {
                                         'level': on_level,
-                                        'id': level['entities'][i]['id']
+                                        'id': level['entities'][i].id
                                     }
                                 )
 
                                 player_entity = level['entities'].pop(i)
+                                self.WorldManager.unplaceEntity(
+                                    on_level,
+                                    player_entity
+                                )
                                 self.unlinkPlayerFromLevel(sid, on_level)
 
                                 break
 
-                    # Set the player to be on the new level
                     target = level['elements']['stairs down']['target']
-                    self.players[sid]['on level'] = target
 
-                    self.linkPlayerToLevel(sid, target)
+                    # The new level is run somewhere else, so hand the
+                    #     player over and forget about them here
+                    if self.handoff:
+                        self.handoff(
+                            sid,
+                            self.players[sid]['username'],
+                            target,
+                            player_entity.getComponents()
+                        )
+
+                        self.EntityManager.removeEntity(player_entity.id)
+                        self.InterestManager.forget(sid)
+                        del self.players[sid]
+
+                        return {
+                            'response': 'handoff',
+                            'data': target
+                        }
+
+                    # Set the player to be on the new level
+                    self.players[sid]['on level'] = target
 
                     # Load the level if it hasn't been already
                     if not self.WorldManager.levelLoaded(target):
                         self.WorldManager.loadLevel(target, self.EntityManager)
 
+                    self.linkPlayerToLevel(sid, target)
+
                     target_level = self.WorldManager.getLevel(target)
 
                     # Set up the player's entity to be on the new level
                     spawn_x = target_level['elements']['spawn']['x']
                     spawn_y = target_level['elements']['spawn']['y']
 
-                    player_entity['components']['position']['x'] = spawn_x
-                    player_entity['components']['position']['y'] = spawn_y
-                    player_entity['updated'] = True
+                    player_entity.x = spawn_x
+                    player_entity.y = spawn_y
+
+                    # Players on the new level haven't seen the entity yet,
+                    #     so all of it needs to be sent
+                    player_entity.markDirty()
 
                     # Put the player entity into the data of the new level
                     if 'entities' not in target_level.keys():
                         target_level['entities'] = []
 
                     target_level['entities'].append(player_entity)
-
-                    # Since the old player entity was removed, we also need to
-                    #     update the entry in the entity manager
-                    self.EntityManager.replace(
-                        player_entity['id'],
-                        player_entity
-                    )
+                    self.WorldManager.placeEntity(target, player_entity)
 
                     return {
                         'response': 'level change',
                         'data': target
                     }
 
-    # Checks for updated (changed) entities, and sends the updated data to
-    #     relevant players (usually players on the same level)
+    # Inactive entities can be forgotten, unless they belong to a player who
+    #     is still connected
+    def forgettable(self, e):
+        if e.active:
+            return False
+
+        if e.hasComponent('sid'):
+            return e.getComponent('sid')['sid'] not in self.players
+
+        return True
+
+    # Unloads levels that are no longer needed. Levels that players are on
+    #     are kept, even if the players haven't been linked to them yet
+    def updateEviction(self):
+        in_use = set(p['on level'] for p in self.players.values())
+
+        for level_id in self.WorldManager.evictLevels(self.EntityManager, in_use):  # noqa
+            self.links.pop(level_id, None)
+
+            # Anyone still in the level's room is taken out of it at the next
+            #     emit (see syncRooms)
+            room = self.levelRoom(level_id)
+
+            for sid in self.rooms.pop(level_id, ()):
+                self.rooms_to_leave.append((sid, room))
+
+    # The name of the socket.io room that players on a level are put in
+    def levelRoom(self, level_id):
+        return 'level ' + level_id
+
+    # Puts players into (and takes them out of) the socket.io rooms of the
+    #     levels that they're linked to
+    def syncRooms(self, sio):
+        for sid, room in self.rooms_to_leave:
+            sio.leave_room(sid, room)
+
+        self.rooms_to_leave = []
+
+        for level_id in self.links.keys():
+            if level_id not in self.rooms.keys():
+                self.rooms[level_id] = set()
+
+            linked = set(self.links[level_id])
+            room = self.levelRoom(level_id)
+
+            for sid in linked - self.rooms[level_id]:
+                sio.enter_room(sid, room)
+
+            for sid in self.rooms[level_id] - linked:
+                sio.leave_room(sid, room)
+
+            self.rooms[level_id] = linked
+
+    # Encodes the changes to an entity as a list, which is smaller and quicker
+    #     to encode than the entity itself. dirty has the bits of the
+    #     components that have changed (e.g. e.dirty, or e.ALL for all of
+    #     them):
+    #     [id] if the entity is no longer active,
+    #     [id, x, y] if only its position has changed, or
+    #     [id, x, y, components] if other components have changed, where x
+    #         and y are None if its position hasn't changed.
+    # Returns None if nothing has changed
+    def encodeEntity(self, e, dirty):
+        if not e.active:
+            return [e.id]
+
+        if not dirty:
+            return None
+
+        x = None
+        y = None
+
+        if dirty & e.store.POSITION and e.hasComponent('position'):
+            x = e.x
+            y = e.y
+
+        if dirty == e.store.POSITION:
+            return [e.id, x, y]
+
+        components = e.getComponents(dirty)
+        components.pop('position', None)
+
+        if not components:
+            return [e.id, x, y]
+
+        return [e.id, x, y, components]
+
+    # Returns the level that a player is on, in the form that's sent to
+    #     clients. On levels too big to fit on a screen, only the entities
+    #     that the player can see are included.
+    # held has the versions of levels that the client already has the tiles
+    #     of (level ID -> version). If it has this level's, they're marked as
+    #     cached and aren't sent again
+    def getPublicLevel(self, sid, held=None):
+        level_id = self.players[sid]['on level']
+        level = self.WorldManager.getLevel(level_id)
+
+        visible = None
+        radius = self.InterestManager.viewRadius(level)
+
+        if radius is not None:
+            visible = self.visibleEntities(sid, level_id, radius)
+            self.InterestManager.setView(sid, level_id, visible.keys())
+
+        public_level = self.WorldManager.getPublicLevel(level_id, visible)
+
+        # The tiles are sent afterwards in chunks, which the client puts
+        #     together with this
+        transfer = self.WorldManager.getLevelTransfer(level_id)
+
+        cached = (
+            isinstance(held, dict) and
+            held.get(level_id) == transfer['version']
+        )
+
+        public_level['transfer'] = {
+            'version': transfer['version'],
+            'palette': transfer['palette'],
+            'cached': cached,
+            'chunks': 0 if cached else len(transfer['chunks'])
+        }
+
+        # So that the client knows which entity is theirs
+        public_level['player'] = self.players[sid]['entity']
+
+        return public_level
+
+    # Returns the entities that a player can see, as entity ID -> entity
+    def visibleEntities(self, sid, level_id, radius):
+        player = self.EntityManager.getEntity(self.players[sid]['entity'])
+
+        return self.WorldManager.entitiesWithin(
+            level_id,
+            player.x,
+            player.y,
+            radius
+        )
+
+    # Checks for updated (changed) entities, and sends one batch of changes
+    #     per level to the players on that level. On levels too big to fit on
+    #     a screen, each player is sent their own batch, with only the
+    #     entities they can see
     def emitUpdates(self, sio):
-        # First emit entities that need to be destroyed
+        self.syncRooms(sio)
+
+        # Level ID -> changes to send to players on that level
+        batches = {}
+
+        # First add entities that need to be destroyed
         for e in self.entities_to_destroy:
-            log('Manager', f'Destroy entity {e["id"]} (client-side)', 'debug')
+            log(
+                'Manager',
+                'Destroy entity {id} (client-side)',
+                'debug',
+                id=e['id']
+            )
+
+            if e['level'] not in batches.keys():
+                batches[e['level']] = {
+                    'level': e['level'],
+                    'entities': [],
+                    'destroy': []
+                }
 
-            for p in self.links[e['level']]:
-                sio.emit('destroy entity', e['id'], room=p)
+            batches[e['level']]['destroy'].append(e['id'])
 
         self.entities_to_destroy = []
 
-        # Then emit updates
-        to_reset = []  # Entities that need their "updated" status reset
+        # Then add updates
+        for level_id in self.links.keys():
+            if not self.links[level_id]:
+                continue
+
+            level = self.WorldManager.getLevel(level_id)
 
-        for l in self.links.keys():
-            for p in self.links[l]:
-                entity_updates = []
-                present_level = self.getPresentLevel(p)
+            if 'entities' not in level.keys():
+                continue
 
-                if 'entities' in present_level.keys():
-                    for e in present_level['entities']:
-                        if e['updated']:
-                            entity_updates.append(e)
-                            to_reset.append(e)
+            forgotten = False
+            deltas = {}  # Entity ID -> encoded changes
 
-                if len(entity_updates) > 0:
-                    sio.emit('entity updates', entity_updates, room=p)
+            for e in level['entities']:
+                if not e.updated:
+                    continue
 
-        for e in to_reset:
-            e['updated'] = False
+                e.updated = False
+                delta = self.encodeEntity(e, e.dirty)
+                e.dirty = 0
+
+                # Once players have been told that an entity is gone, it
+                #     doesn't need to be kept around
+                if self.forgettable(e):
+                    self.EntityManager.removeEntity(e.id)
+                    forgotten = True
+
+                if delta:
+                    deltas[e.id] = delta
+
+            if forgotten:
+                level['entities'] = [
+                    e for e in level['entities']
+                    if self.EntityManager.hasEntity(e.id)
+                ]
+
+            radius = self.InterestManager.viewRadius(level)
+
+            if radius is not None:
+                batch = batches.pop(level_id, None)
+                destroy = batch['destroy'] if batch else []
+
+                self.emitVisibleUpdates(sio, level_id, radius, deltas, destroy)  # noqa
+            elif deltas:
+                if level_id not in batches.keys():
+                    batches[level_id] = {
+                        'level': level_id,
+                        'entities': [],
+                        'destroy': []
+                    }
+
+                batches[level_id]['entities'].extend(deltas.values())
+
+        for level_id, batch in batches.items():
+            if self.rooms.get(level_id):
+                sio.emit(
+                    'level update',
+                    batch,
+                    room=self.levelRoom(level_id)
+                )
+
+    # Sends each player on a level the changes to the entities they can see.
+    #     Entities that have come into view are sent in full, and the IDs of
+    #     those that have gone out of view are sent so they can be removed
+    def emitVisibleUpdates(self, sio, level_id, radius, deltas, destroy):
+        for sid in self.links[level_id]:
+            if sid not in self.players.keys():
+                continue
+
+            visible = self.visibleEntities(sid, level_id, radius)
+
+            entered, left = self.InterestManager.updateView(
+                sid,
+                level_id,
+                visible.keys()
+            )
+
+            entities = [
+                self.encodeEntity(visible[i], visible[i].ALL)
+                for i in sorted(entered)
+            ]
+
+            for ent_id in visible.keys():
+                if ent_id in deltas and ent_id not in entered:
+                    entities.append(deltas[ent_id])
+
+            if not entities and not left and not destroy:
+                continue
+
+            sio.emit(
+                'level update',
+                {
+                    'level': level_id,
+                    'entities': entities,
+                    'destroy': destroy,
+                    'leave': sorted(left)
+                },
+                room=sid
+            )
 
     # Handle all periodic updates to the world
     def doUpdates(self):
+        self.updateSpawns()
+        self.updateAI()
+        self.updateCombat()
+        self.updateEviction()
+
+    # The phases of a periodic update. These are separate so that the time
+    #     each takes can be measured
+    def updateSpawns(self):
         self.WorldManager.spawnMonsters(self.EntityManager)
+
+    def updateAI(self):
         self.WorldManager.updateMonsters(self.EntityManager, self.CombatManager)  # noqa
+
+    def updateCombat(self):
+        self.WorldManager.updateCombat()
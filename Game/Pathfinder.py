@@ -0,0 +1,124 @@
+from array import array
+import collections
+
+
+# Finds the way to players for monsters that chase them.
+# For each entity being chased there's a flow field: how many steps it takes
+#     to reach the entity from each tile around it, going around walls. All
+#     of the monsters chasing an entity share its field, and each steps onto
+#     whichever tile next to it is closest.
+# Fields only cover the tiles within a radius of the entity, so remaking one
+#     after the entity moves a tile only costs a search of that area, not of
+#     the whole level. They're only remade when a monster needs one and the
+#     entity has moved since it was made, so it's at most one search per
+#     chased entity per tick, however many monsters are chasing it
+class Pathfinder:
+    unreachable = 0xFFFF
+
+    def __init__(self, radius=24):
+        self.radius = radius
+
+        # Level ID -> entity ID -> field
+        self.fields = {}
+
+        # The offsets of the 8 tiles around a tile
+        self.directions = [
+            (-1, -1), (0, -1), (1, -1),
+            (-1, 0), (1, 0),
+            (-1, 1), (0, 1), (1, 1)
+        ]
+
+    # Returns the flow field towards an entity, making it if the entity has
+    #     moved since it was last made.
+    # walkable has a byte for each tile of the level, which is 1 for tiles
+    #     that can be walked on
+    def getField(self, level_id, target, walkable, w, h):
+        if level_id not in self.fields.keys():
+            self.fields[level_id] = {}
+
+        field = self.fields[level_id].get(target.id)
+
+        if field and field['x'] == target.x and field['y'] == target.y:
+            return field
+
+        field = self.makeField(target.x, target.y, walkable, w, h)
+        self.fields[level_id][target.id] = field
+
+        return field
+
+    # Searches outwards from a tile, counting the steps to each tile within
+    #     the radius
+    def makeField(self, x, y, walkable, w, h):
+        r = self.radius
+        size = 2 * r + 1
+
+        left = x - r
+        top = y - r
+
+        # Which tiles in the field's square can be walked on and haven't been
+        #     reached yet. Padded by a border of one tile that can't be walked
+        #     on, so that the search never goes out of the square
+        stride = size + 2
+        open_tiles = bytearray(stride * stride)
+
+        for row in range(max(0, top), min(h, top + size)):
+            start = max(0, left)
+            end = min(w, left + size)
+
+            i = (row - top + 1) * stride + (start - left + 1)
+            open_tiles[i:i + end - start] = walkable[row * w + start:row * w + end]  # noqa
+
+        offsets = [dy * stride + dx for dx, dy in self.directions]
+
+        distances = array('H', [self.unreachable]) * (stride * stride)
+
+        origin = (r + 1) * stride + (r + 1)
+        distances[origin] = 0
+        open_tiles[origin] = 0
+
+        queue = collections.deque([origin])
+
+        while queue:
+            i = queue.popleft()
+            distance = distances[i] + 1
+
+            for offset in offsets:
+                j = i + offset
+
+                if open_tiles[j]:
+                    open_tiles[j] = 0
+                    distances[j] = distance
+                    queue.append(j)
+
+        return {
+            'x': x,
+            'y': y,
+            'left': left - 1,  # The level coordinates of index 0
+            'top': top - 1,
+            'stride': stride,
+            'distances': distances
+        }
+
+    # Returns the number of steps from a tile to a field's entity, or None if
+    #     the tile is outside the field or can't reach the entity within it
+    def distance(self, field, x, y):
+        field_x = x - field['left']
+        field_y = y - field['top']
+        stride = field['stride']
+
+        if field_x < 0 or field_x >= stride or field_y < 0 or field_y >= stride:  # noqa
+            return None
+
+        distance = field['distances'][field_y * stride + field_x]
+
+        if distance == self.unreachable:
+            return None
+
+        return distance
+
+    def forgetEntity(self, level_id, ent_id):
+        if level_id in self.fields.keys():
+            self.fields[level_id].pop(ent_id, None)
+
+    def forgetLevel(self, level_id):
+        self.fields.pop(level_id, None)
@@ -0,0 +1,116 @@
+from log import log
+
+import collections
+import math
+import time
+
+
+# Runs the periodic updates of the game at a fixed tick rate, and keeps track
+#     of how long each tick (and each phase of a tick) takes
+class Scheduler:
+    def __init__(self, sleep, tick_rate=1, window=1000):
+        self.sleep = sleep  # Should yield to other threads, e.g. sio.sleep
+        self.setTickRate(tick_rate)
+
+        # Functions to run each tick, in order, as (name, function) pairs
+        self.phases = []
+
+        # Durations (in seconds) of the most recent ticks and phases
+        self.window = window
+        self.tick_durations = collections.deque(maxlen=window)
+        self.phase_durations = {}
+
+        self.ticks = 0
+        self.overruns = 0  # Ticks that didn't finish before the next was due
+        self.running = False
+
+    def setTickRate(self, tick_rate):
+        self.tick_rate = tick_rate
+        self.period = 1 / tick_rate
+
+    # Adds a function to be run each tick
+    def addPhase(self, name, function):
+        self.phases.append((name, function))
+        self.phase_durations[name] = collections.deque(maxlen=self.window)
+
+    # Runs all phases once. Returns how long it took
+    def tick(self):
+        tick_start = time.perf_counter()
+
+        for name, function in self.phases:
+            phase_start = time.perf_counter()
+            function()
+            self.phase_durations[name].append(
+                time.perf_counter() - phase_start)
+
+        duration = time.perf_counter() - tick_start
+
+        self.tick_durations.append(duration)
+        self.ticks += 1
+
+        return duration
+
+    # Runs ticks until stopped. Ticks are scheduled against a fixed timeline
+    #     rather than by sleeping for a full period after each one, so the
+    #     time spent in a tick doesn't make the loop drift
+    def run(self):
+        self.running = True
+        next_tick = time.perf_counter()
+
+        while self.running:
+            self.tick()
+
+            next_tick += self.period
+            delay = next_tick - time.perf_counter()
+
+            if delay < 0:
+                self.overruns += 1
+
+                log(
+                    'Scheduler',
+                    f'Tick {self.ticks} overran by {-delay * 1000:.1f}ms \
+({self.overruns} overruns so far)',
+                    'warning'
+                )
+
+                # Don't try to catch up with a burst of ticks. Just carry on
+                #     from now
+                next_tick = time.perf_counter()
+                delay = 0
+
+            self.sleep(delay)
+
+    def stop(self):
+        self.running = False
+
+    # Returns the given percentile of a list of sorted values
+    def percentile(self, values, p):
+        if not values:
+            return 0
+
+        rank = max(0, math.ceil(p / 100 * len(values)) - 1)
+        return values[rank]
+
+    # Summarizes a set of durations, in milliseconds
+    def summarize(self, durations):
+        values = sorted(durations)
+
+        return {
+            'p50': self.percentile(values, 50) * 1000,
+            'p99': self.percentile(values, 99) * 1000,
+            'max': (values[-1] if values else 0) * 1000
+        }
+
+    # Returns statistics about recent ticks
+    def stats(self):
+        return {
+            'tick_rate': self.tick_rate,
+            'budget': self.period * 1000,
+            'ticks': self.ticks,
+            'overruns': self.overruns,
+            'tick': self.summarize(self.tick_durations),
+            'phases': {
+                name: self.summarize(durations)
+                for name, durations in self.phase_durations.items()
+            }
+        }
@@ -0,0 +1,40 @@
+import multiprocessing
+
+
+# Keeps track of the clients connected to a server process, and of how many
+#     players are online. The count can be shared by several processes (e.g.
+#     front-ends) by giving each the same multiprocessing.Value
+class Sessions:
+    def __init__(self, players_online=None):
+        # A dictionary of clients, including ones that have disconnected
+        self.clients = {}
+
+        if players_online is None:
+            players_online = multiprocessing.Value('i', 0)
+
+        self.players_online = players_online
+
+    def connect(self, sid):
+        self.clients[sid] = {
+            'online': True
+        }
+
+        with self.players_online.get_lock():
+            self.players_online.value += 1
+
+    def disconnect(self, sid):
+        if sid not in self.clients.keys():
+            return
+
+        self.clients[sid]['online'] = False
+        self.clients[sid]['logged in'] = False
+
+        with self.players_online.get_lock():
+            self.players_online.value -= 1
+
+    def login(self, sid, username):
+        self.clients[sid]['username'] = username
+        self.clients[sid]['logged in'] = True
+
+    def online(self):
+        return self.players_online.value
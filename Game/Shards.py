@@ -0,0 +1,277 @@
+from log import log
+
+from . import Handlers
+from . import InputQueue
+from . import Manager
+from . import Scheduler
+from . import Snapshots
+
+import multiprocessing
+import queue
+import time
+
+
+# Runs the game world across several processes, so that it isn't limited to
+#     one core. Levels are split between worker processes, which each run
+#     their own Manager and tick. The process that clients connect to runs a
+#     router, which sends each client's events to the worker running the
+#     level they're on, and sends out whatever the workers want to emit.
+# Players are handed from one worker to another when they go down stairs.
+# Workers and the router talk through multiprocessing queues. Messages are
+#     tuples, starting with the message type
+
+
+# Stands in for a socketio.Server in a worker process. Emits and room
+#     changes are put in a queue for the router to carry out
+class QueueSio:
+    def __init__(self, outbox):
+        self.outbox = outbox
+
+    def emit(self, event, data=None, room=None):
+        self.outbox.put(('emit', event, data, room))
+
+    def enter_room(self, sid, room):
+        self.outbox.put(('enter room', sid, room))
+
+    def leave_room(self, sid, room):
+        self.outbox.put(('leave room', sid, room))
+
+
+# Runs part of the game world. Messages from the router are handled while
+#     waiting between ticks, and players' actions are handled in rounds
+#     (see InputQueue), move_rate times a second.
+# Without handoff, the worker runs the whole world, and players are moved
+#     between levels by the worker itself. Only then can the world be saved
+#     to (and restored from) a snapshot directory
+class ShardWorker:
+    def __init__(self, index, inbox, outbox, tick_rate=1, handoff=True,
+                 snapshot_directory=None, snapshot_interval=60, move_rate=10):
+        self.index = index
+        self.inbox = inbox
+        self.outbox = outbox
+
+        self.manager = Manager.Manager()
+
+        if handoff:
+            self.manager.handoff = self.handOff
+
+        self.sio = QueueSio(outbox)
+
+        self.scheduler = Scheduler.Scheduler(self.wait, tick_rate)
+
+        self.scheduler.addPhase('spawn', self.manager.updateSpawns)
+        self.scheduler.addPhase('ai', self.manager.updateAI)
+        self.scheduler.addPhase('combat', self.manager.updateCombat)
+        self.scheduler.addPhase('evict', self.manager.updateEviction)
+        self.scheduler.addPhase(
+            'emit',
+            lambda: self.manager.emitUpdates(self.sio)
+        )
+
+        if snapshot_directory and not handoff:
+            snapshots = Snapshots.Snapshots(
+                self.manager,
+                snapshot_directory,
+                snapshot_interval
+            )
+
+            snapshots.restore()
+            self.scheduler.addPhase('snapshot', snapshots.update)
+
+        self.handlers = InputQueue.InputQueue(Handlers.Handlers(
+            self.manager,
+            self.sio,
+            self.scheduler
+        ))
+
+        self.input_period = 1 / move_rate
+        self.next_inputs = time.perf_counter()
+
+    def run(self):
+        log('ShardWorker', f'Worker {self.index} started')
+        self.scheduler.run()
+        log('ShardWorker', f'Worker {self.index} stopped')
+
+    # Handles messages until the given number of seconds have passed. Used
+    #     by the scheduler to wait between ticks
+    def wait(self, seconds):
+        deadline = time.perf_counter() + seconds
+
+        # Levels that will be needed soon are read while there's time
+        self.manager.WorldManager.preloadLevels()
+
+        while self.scheduler.running:
+            now = time.perf_counter()
+
+            if now >= self.next_inputs:
+                self.handlers.process()
+
+                # Rounds that were missed aren't made up for
+                self.next_inputs = max(self.next_inputs + self.input_period, now)  # noqa
+
+            timeout = min(deadline, self.next_inputs) - time.perf_counter()
+
+            try:
+                if timeout > 0:
+                    message = self.inbox.get(timeout=timeout)
+                else:
+                    message = self.inbox.get_nowait()
+            except queue.Empty:
+                if time.perf_counter() >= deadline:
+                    return
+
+                continue
+
+            self.handle(message)
+
+    def handle(self, message):
+        if message[0] == 'stop':
+            self.scheduler.stop()
+        elif not Handlers.dispatch(self.handlers, message):
+            log(
+                'ShardWorker',
+                f'Unknown message type {message[0]}',
+                'error'
+            )
+
+    # A player has gone down stairs to a level that might be run by another
+    #     worker, so the router decides where they go
+    def handOff(self, sid, username, level_id, components):
+        self.outbox.put(('handoff', sid, username, level_id, components))
+
+
+# The entry point of worker processes
+def runWorker(index, inbox, outbox, tick_rate, handoff=True, move_rate=10):
+    ShardWorker(
+        index,
+        inbox,
+        outbox,
+        tick_rate,
+        handoff,
+        move_rate=move_rate
+    ).run()
+
+
+# Runs in the process that clients connect to. Starts the workers, decides
+#     which worker runs each level, and passes messages between clients and
+#     workers
+class ShardRouter:
+    def __init__(self, sio, workers, default_level, tick_rate=1, move_rate=10):
+        self.sio = sio
+        self.default_level = default_level
+
+        self.outbox = multiprocessing.Queue()  # Shared by all workers
+        self.inboxes = []
+        self.processes = []
+
+        for i in range(0, workers):
+            inbox = multiprocessing.Queue()
+
+            self.inboxes.append(inbox)
+            self.processes.append(multiprocessing.Process(
+                target=runWorker,
+                args=(i, inbox, self.outbox, tick_rate, True, move_rate),
+                daemon=True
+            ))
+
+        self.levels = {}  # Level ID -> index of the worker that runs it
+        self.players = {}  # SID -> index of the worker the player is on
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+
+    def stop(self):
+        for inbox in self.inboxes:
+            inbox.put(('stop',))
+
+        for process in self.processes:
+            process.join()
+
+    # Returns the worker that runs a level. Levels that aren't run by any
+    #     worker yet go to the worker running the fewest levels
+    def assign(self, level_id):
+        if level_id not in self.levels.keys():
+            counts = [0] * len(self.inboxes)
+
+            for worker in self.levels.values():
+                counts[worker] += 1
+
+            self.levels[level_id] = counts.index(min(counts))
+
+            log(
+                'ShardRouter',
+                'Level {level_id} -> worker {worker}',
+                'debug',
+                level_id=level_id,
+                worker=self.levels[level_id]
+            )
+
+        return self.levels[level_id]
+
+    # Sends a message to the worker that a player is on
+    def send(self, sid, *message):
+        if sid in self.players.keys():
+            self.inboxes[self.players[sid]].put(message)
+
+    # Events from clients, which have the same methods as Handlers
+    def login(self, sid, username):
+        self.players[sid] = self.assign(self.default_level)
+        self.send(sid, 'login', sid, username)
+
+    def disconnect(self, sid):
+        self.send(sid, 'disconnect', sid)
+        self.players.pop(sid, None)
+
+    def requestPresentLevel(self, sid, held=None):
+        self.send(sid, 'request present level', sid, held)
+
+    def action(self, sid, action_type, details):
+        self.send(sid, 'action', sid, action_type, details)
+
+    def requestStats(self, sid):
+        self.send(sid, 'request stats', sid)
+
+    # Carries out the messages that workers have sent, until there are none
+    #     left. Returns how many there were
+    def relay(self):
+        handled = 0
+
+        while True:
+            try:
+                message = self.outbox.get_nowait()
+            except queue.Empty:
+                return handled
+
+            handled += 1
+            message_type = message[0]
+
+            if message_type == 'emit':
+                event, data, room = message[1:]
+                self.sio.emit(event, data, room=room)
+            elif message_type == 'enter room':
+                self.sio.enter_room(*message[1:])
+            elif message_type == 'leave room':
+                self.sio.leave_room(*message[1:])
+            elif message_type == 'handoff':
+                self.handOff(*message[1:])
+
+    # Moves a player who has gone down stairs to the worker running the level
+    #     they're going to. The client is only told to ask for the new level
+    #     once that worker has been told about them
+    def handOff(self, sid, username, level_id, components):
+        # The player disconnected while being handed off
+        if sid not in self.players.keys():
+            return
+
+        self.players[sid] = self.assign(level_id)
+        self.send(sid, 'login', sid, username, level_id, components)
+
+        self.sio.emit('level change', room=sid)
+
+    # Relays messages from workers until stopped. sleep should yield to other
+    #     threads, e.g. sio.sleep
+    def run(self, sleep):
+        while True:
+            if not self.relay():
+                sleep(0.005)
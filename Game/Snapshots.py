@@ -0,0 +1,381 @@
+from log import log
+
+from array import array
+import copy
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+import urllib.parse
+
+
+# Saves the world to disk every so often, so that it can be restored after a
+#     restart instead of starting again from scratch.
+# Each level is saved to a file of its own, with its entities packed (see
+#     EntityManager.packEntities). The tiles of generated levels are saved
+#     separately, in files named after a hash of the tiles, so each grid is
+#     only written once. Levels that haven't changed since they were last
+#     saved (sleeping and unloaded levels) aren't written again.
+# Saving only copies the entity store's columns and a few lists between
+#     ticks. Entities are packed, and the files written, by a background
+#     thread.
+# Restoring doesn't load any levels. They're put in the world manager's level
+#     snapshots, and come back as they were when they're next loaded.
+#     Players who were online come back where they were when they log in
+class Snapshots:
+    magic = b'PTWS'
+    file_version = 1
+
+    # The start of every file: magic, file version, and the length of the
+    #     JSON header that comes after it. The rest of the file is data
+    file_header = struct.Struct('<4sHI')
+
+    def __init__(self, manager, directory='snapshots', interval=60):
+        self.manager = manager
+        self.directory = directory
+        self.interval = interval  # Seconds between saves
+
+        self.levels_directory = os.path.join(directory, 'levels')
+        self.tiles_directory = os.path.join(directory, 'tiles')
+        self.players_file = os.path.join(directory, 'players.bin')
+
+        # What each level was when it was last saved: the time it went to
+        #     sleep, or its level snapshot. Level ID -> token
+        self.saved = {}
+
+        # The tiles that each saved level uses. Level ID -> tiles hash
+        self.level_tiles = {}
+
+        self.last_save = time.monotonic()
+        self.writer = None  # The thread writing the last save
+
+        # Set by the writer when the last save couldn't be written
+        self.failed = False
+
+    # Saves the world if it's time to. Meant to be run as a scheduler phase
+    def update(self):
+        if time.monotonic() - self.last_save >= self.interval:
+            self.save()
+
+    # Captures the world, and starts writing it in the background. Skipped
+    #     if the last save hasn't been written yet
+    def save(self):
+        if self.writer and self.writer.is_alive():
+            log('Snapshots', 'Still writing the last save', 'warning')
+            return
+
+        self.last_save = time.monotonic()
+
+        # Everything is written again after a failed save. saved is only
+        #     changed here, on the game thread, since capture uses it
+        if self.failed:
+            self.saved = {}
+            self.failed = False
+
+        job = self.capture()
+
+        self.writer = threading.Thread(target=self.write, args=(job,))
+        self.writer.start()
+
+    # Copies whatever has changed since the last save, and returns it to be
+    #     written
+    def capture(self):
+        world_manager = self.manager.WorldManager
+        entity_manager = self.manager.EntityManager
+
+        job = {
+            'store': entity_manager.store.copy(),
+            'levels': {},
+            'removed': [],
+            'players': None
+        }
+
+        tokens = {}
+
+        for level_id, level in world_manager.levels.items():
+            # Active levels are always saved, since things happen on them.
+            #     Sleeping levels don't change until they wake up
+            token = world_manager.sleeping_levels.get(level_id)
+            tokens[level_id] = token
+
+            if token is not None and self.saved.get(level_id) is token:
+                continue
+
+            # The entities are packed when the level is written
+            snapshot = {
+                'rows': list(entity_manager.store.level_rows.get(level_id, ()))
+            }
+
+            if 'generator' in level['level'].keys():
+                snapshot['tiles'] = world_manager.grids[level_id]['tiles']
+                snapshot['elements'] = copy.deepcopy(level['elements'])
+
+            job['levels'][level_id] = snapshot
+
+        # Level snapshots are never changed, only replaced
+        for level_id, snapshot in world_manager.level_snapshots.items():
+            tokens[level_id] = snapshot
+
+            if self.saved.get(level_id) is not snapshot:
+                job['levels'][level_id] = snapshot
+
+        job['removed'] = [
+            level_id for level_id in self.saved.keys()
+            if level_id not in tokens.keys()
+        ]
+
+        self.saved = tokens
+
+        # Players who haven't come back since the last restore are kept
+        players = dict(self.manager.saved_players)
+
+        for player in self.manager.players.values():
+            components = entity_manager.getEntity(player['entity']).getComponents()  # noqa
+
+            components.pop('position', None)
+            components.pop('sid', None)
+
+            players[player['username']] = {
+                'level': player['on level'],
+                'components': components
+            }
+
+        job['players'] = json.dumps(players)
+
+        return job
+
+    # Writes what was captured
+    def write(self, job):
+        start = time.perf_counter()
+
+        try:
+            os.makedirs(self.levels_directory, exist_ok=True)
+            os.makedirs(self.tiles_directory, exist_ok=True)
+
+            for level_id, snapshot in job['levels'].items():
+                if 'rows' in snapshot.keys():
+                    snapshot['entities'] = self.packEntities(
+                        job['store'],
+                        snapshot.pop('rows')
+                    )
+
+                self.writeLevel(level_id, snapshot)
+
+            for level_id in job['removed']:
+                self.level_tiles.pop(level_id, None)
+
+                try:
+                    os.remove(self.levelPath(level_id))
+                except FileNotFoundError:
+                    pass
+
+            self.writeFile(
+                self.players_file,
+                {'players': json.loads(job['players'])}
+            )
+
+            self.removeUnusedTiles()
+        except OSError as e:
+            log('Snapshots', 'Failed to save: {error}', 'error', error=e)
+
+            self.failed = True
+            return
+
+        log(
+            'Snapshots',
+            'Saved {count} levels in {ms:.1f}ms',
+            'debug',
+            count=len(job['levels']),
+            ms=(time.perf_counter() - start) * 1000
+        )
+
+    # Packs the entities of a level, leaving out players (who are saved
+    #     separately) and entities that are no longer active
+    def packEntities(self, store, rows):
+        rows = [
+            row for row in rows
+            if store.active[row] and not store.records[row].hasComponent('sid')
+        ]
+
+        return self.manager.EntityManager.packEntities(rows, store)
+
+    def writeLevel(self, level_id, snapshot):
+        header = {
+            'id': level_id,
+            'tiles': None,
+            'elements': snapshot.get('elements'),
+            'entities': None
+        }
+
+        data = b''
+
+        if 'tiles' in snapshot.keys():
+            tiles = snapshot['tiles'].tobytes()
+            tiles_hash = hashlib.sha1(tiles).hexdigest()[:16]
+            path = self.tilesPath(tiles_hash)
+
+            if not os.path.exists(path):
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(tiles)
+
+                os.replace(path + '.tmp', path)
+
+            header['tiles'] = tiles_hash
+            self.level_tiles[level_id] = tiles_hash
+
+        if 'entities' in snapshot.keys():
+            header['entities'] = {
+                key: value for key, value in snapshot['entities'].items()
+                if key != 'data'
+            }
+
+            data = snapshot['entities']['data']
+
+        self.writeFile(self.levelPath(level_id), header, data)
+
+    # Tiles that no saved level uses any more
+    def removeUnusedTiles(self):
+        used = set(self.level_tiles.values())
+
+        for filename in os.listdir(self.tiles_directory):
+            tiles_hash, extension = os.path.splitext(filename)
+
+            if extension == '.bin' and tiles_hash not in used:
+                os.remove(os.path.join(self.tiles_directory, filename))
+
+    # Puts the saved world back. Returns True if there was one
+    def restore(self):
+        world_manager = self.manager.WorldManager
+
+        if not os.path.isdir(self.levels_directory):
+            return False
+
+        start = time.perf_counter()
+        restored = 0
+
+        for filename in os.listdir(self.levels_directory):
+            if not filename.endswith('.bin'):
+                continue
+
+            contents = self.readFile(
+                os.path.join(self.levels_directory, filename))
+
+            if not contents:
+                continue
+
+            header, data = contents
+            level_id = header['id']
+
+            if level_id not in world_manager.defined_levels.keys():
+                continue
+
+            if world_manager.levelLoaded(level_id):
+                continue
+
+            snapshot = {}
+
+            if header['tiles']:
+                tiles = self.readTiles(header['tiles'])
+
+                if tiles is None:
+                    log(
+                        'Snapshots',
+                        'Missing tiles for level {level_id}',
+                        'warning',
+                        level_id=level_id
+                    )
+
+                    continue
+
+                snapshot['tiles'] = tiles
+                snapshot['elements'] = header['elements']
+
+                self.level_tiles[level_id] = header['tiles']
+
+            if header['entities']:
+                snapshot['entities'] = header['entities']
+                snapshot['entities']['data'] = data
+
+            world_manager.level_snapshots[level_id] = snapshot
+
+            # It's already on disk
+            self.saved[level_id] = snapshot
+
+            restored += 1
+
+        contents = self.readFile(self.players_file)
+
+        if contents:
+            self.manager.saved_players = contents[0]['players']
+
+        log(
+            'Snapshots',
+            'Restored {count} levels and {players} players in {ms:.1f}ms',
+            count=restored,
+            players=len(self.manager.saved_players),
+            ms=(time.perf_counter() - start) * 1000
+        )
+
+        return True
+
+    def levelPath(self, level_id):
+        filename = urllib.parse.quote(level_id, safe='') + '.bin'
+        return os.path.join(self.levels_directory, filename)
+
+    def tilesPath(self, tiles_hash):
+        return os.path.join(self.tiles_directory, tiles_hash + '.bin')
+
+    # Writes a file made of a header (which must be JSON serializable) and
+    #     data. The file is replaced all at once, so there's never half of
+    #     one on disk
+    def writeFile(self, path, header, data=b''):
+        header_json = json.dumps(header).encode()
+
+        with open(path + '.tmp', 'wb') as f:
+            f.write(self.file_header.pack(
+                self.magic,
+                self.file_version,
+                len(header_json)
+            ))
+
+            f.write(header_json)
+            f.write(data)
+
+        os.replace(path + '.tmp', path)
+
+    # Reads a file written by writeFile. Returns (header, data), or None if
+    #     it can't be read
+    def readFile(self, path):
+        try:
+            with open(path, 'rb') as f:
+                contents = f.read()
+
+            magic, file_version, length = self.file_header.unpack_from(
+                contents)
+
+            if magic != self.magic or file_version != self.file_version:
+                log('Snapshots', f'{path} isn\'t a snapshot file', 'warning')
+                return None
+
+            start = self.file_header.size
+            header = json.loads(contents[start:start + length])
+
+            return header, contents[start + length:]
+        except FileNotFoundError:
+            return None
+        except (OSError, struct.error, ValueError) as e:
+            log('Snapshots', f'Failed to read {path}: {e}', 'warning')
+            return None
+
+    def readTiles(self, tiles_hash):
+        tiles = array('B')
+
+        try:
+            with open(self.tilesPath(tiles_hash), 'rb') as f:
+                tiles.frombytes(f.read())
+        except OSError:
+            return None
+
+        return tiles
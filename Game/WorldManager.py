@@ -1,14 +1,31 @@
 from log import log
 
+from . import LevelGenerator
+from . import Pathfinder
+
+from array import array
+import collections
+import copy
+import hashlib
 import json
-import math
 import random
+import re
+import time
 
 
 # Manages the levels of the game world
 class WorldManager:
-    def __init__(self):
+    # rng is used for everything random (e.g. where monsters go), and clock
+    #     for the time (in seconds) that levels go to sleep. Both can be
+    #     replaced so that the world can be run again the same way (see
+    #     Journal)
+    def __init__(self, rng=None, clock=time.monotonic):
+        self.rng = rng or random.Random()
+        self.clock = clock
+
         self.levels = {}
+        self.generator = LevelGenerator.LevelGenerator(self.rng)
+        self.pathfinder = Pathfinder.Pathfinder()
 
         # Load in the list of defined levels
         filename = 'Game/data/world/defined_levels.json'
@@ -26,121 +43,522 @@ class WorldManager:
                 'warning'
             )
 
-        # Define tiles that can be moved on
-        self.valid_movements = [
-            'ground',
-            'tall grass',
-            'stairs down'
+        # Define tiles that can be moved on, and the messages that are shown
+        #     when moving onto (or bumping into) certain tiles.
+        # Tile types that aren't listed can't be moved on
+        self.tile_types = {
+            'ground': {
+                'walkable': True
+            },
+            'tall grass': {
+                'walkable': True,
+                'message': 'You rustle through the tall grass'
+            },
+            'stairs down': {
+                'walkable': True
+            },
+            'wall': {
+                'walkable': False,
+                'message': 'You bump into the wall'
+            }
+        }
+
+        # Tilesets map tile types to the numeric codes used in tile grids.
+        # Loaded as needed. Tileset ID -> tile type -> code
+        self.tilesets = {}
+
+        # Compact tile data of each loaded level. Level ID -> grid
+        self.grids = {}
+
+        # The tiles of levels, encoded for sending to clients. Level ID ->
+        #     transfer (see getLevelTransfer)
+        self.level_transfers = {}
+
+        # Roughly how many tiles are sent to clients in each message
+        self.chunk_tiles = 65536
+
+        # The offsets of the 8 tiles around a tile, that entities can move to
+        self.directions = [
+            (-1, -1), (0, -1), (1, -1),
+            (-1, 0), (1, 0),
+            (-1, 1), (0, 1), (1, 1)
         ]
 
+        # Levels that are being simulated. Used as an ordered set, so that
+        #     levels are always updated in the same order
+        self.active_levels = {}
+
+        # Levels that aren't being simulated, and when they went to sleep.
+        # Ordered from least to most recently used
+        self.sleeping_levels = collections.OrderedDict()
+
+        # Limits on how much can be kept loaded. When there are too many
+        #     levels or tiles loaded, the least recently used sleeping levels
+        #     are unloaded. Levels that have been asleep for too long (in
+        #     seconds) are unloaded either way
+        self.max_loaded_levels = 32
+        self.max_loaded_tiles = 4000000
+        self.max_sleep_time = 600
+
+        # The generated parts of levels that have been unloaded, so that they
+        #     come back the same when loaded again. Level ID -> snapshot:
+        #     {'tiles', 'elements'} for generated levels, and 'entities'
+        #     (packed, see EntityManager.packEntities) for levels restored
+        #     from disk
+        self.level_snapshots = {}
+
+        # Index of which entities stand on which tile of each level.
+        # Maps level ID -> tile index -> {entity ID: entity}
+        self.occupancy = {}
+
+        # Walkable tiles of each level that nobody is standing on, so that a
+        #     random one can be picked quickly. Level ID -> {
+        #         'tiles': the free tile indices, in no particular order,
+        #         'positions': where each tile is in 'tiles' (-1 if not free)
+        #     }
+        self.free_tiles = {}
+
+        # How many living entities of each type are on each level.
+        # Level ID -> entity type -> count
+        self.populations = {}
+
+        # The monsters that each level keeps spawning, as (entity type, max
+        #     number) pairs. Level ID -> list
+        self.spawn_lists = {}
+
+        # Entities of each level grouped into square buckets of tiles, so that
+        #     entities near a position can be found without checking all of
+        #     them. Buckets are at least as wide as the longest aggro range,
+        #     so anything in range of a tile is in its bucket or the ones
+        #     next to it.
+        # Level ID -> (bucket x, bucket y) -> {entity ID: entity}
+        self.buckets = {}
+        self.bucket_sizes = {}  # Level ID -> bucket width in tiles
+
+        # Players on each level. Level ID -> {entity ID: entity}
+        self.level_players = {}
+
+        # Parsed level files, so that loading a level doesn't have to read
+        #     from disk. Level ID -> template
+        self.level_templates = {}
+
+        # Levels whose templates should be read in the background
+        self.preload_queue = collections.deque()
+
     # Returns the ID of the default level (where new players will start)
     def defaultLevel(self):
         return 'test'
 
-    # Loads a level into memory. Returns True on success
-    def loadLevel(self, level_id, entity_manager):
-        log('WorldManager', 'Loading level ' + level_id, 'debug')
+    # Reads and parses a level file. Returns None on failure.
+    # Doesn't read or change any shared state, so it's safe to run outside
+    #     the main thread
+    def readLevelFile(self, level_id):
+        level_filename = self.defined_levels[level_id]
 
-        if level_id in self.defined_levels.keys():
-            level_filename = self.defined_levels[level_id]
+        try:
+            level_data = json.load(open(level_filename, 'r'))
+        except IOError:
+            log('WorldManager', f'Failed to open {level_filename}', 'error')
+            return None
+        except json.decoder.JSONDecodeError:
+            log(
+                'WorldManager',
+                f'Failed to parse {level_filename} (empty?)',
+                'error'
+            )
 
-            try:
-                level_data = json.load(open(level_filename, 'r'))
-            except IOError:
+            return None
+
+        return level_data
+
+    # Returns the template of a level, reading it if it isn't cached. Levels
+    #     are created from templates, and their tiles (converted to a grid of
+    #     codes up front) are shared by every level created from them.
+    # If given, run is used to read the level file and convert its tiles
+    #     (e.g. in another thread). The tileset is loaded by the caller's
+    #     thread, since loading it changes the tileset cache
+    def getTemplate(self, level_id, run=None):
+        if level_id not in self.level_templates.keys():
+            if run:
+                level_data = run(self.readLevelFile, level_id)
+            else:
+                level_data = self.readLevelFile(level_id)
+
+            if not level_data:
+                return None
+
+            tiles = None
+
+            if 'tiles' in level_data['level'].keys():
+                tileset = self.getTileset(level_data['level']['tileset'])
+
+                if not tileset:
+                    return None
+
+                if run:
+                    tiles = run(self.tileCodes, level_data, tileset)
+                else:
+                    tiles = self.tileCodes(level_data, tileset)
+
+                if tiles is None:
+                    return None
+
+            self.level_templates[level_id] = {
+                'data': level_data,
+                'tiles': tiles
+            }
+
+        return self.level_templates[level_id]
+
+    # Queues up a level's template to be read in the background
+    def queuePreload(self, level_id):
+        if level_id not in self.defined_levels.keys():
+            return
+
+        if level_id in self.level_templates.keys():
+            return
+
+        if level_id not in self.preload_queue:
+            self.preload_queue.append(level_id)
+
+    # Reads the templates of queued levels. Meant to be called from a
+    #     background thread, with run set to something that calls functions
+    #     without blocking other threads (e.g. eventlet.tpool.execute)
+    def preloadLevels(self, run=None):
+        while self.preload_queue:
+            level_id = self.preload_queue.popleft()
+
+            if self.getTemplate(level_id, run):
                 log(
                     'WorldManager',
-                    f'Failed to open {level_filename}',
-                    'error'
+                    'Preloaded level {level_id}',
+                    'debug',
+                    level_id=level_id
                 )
 
+    # Loads a level into memory. Returns True on success
+    def loadLevel(self, level_id, entity_manager):
+        log(
+            'WorldManager',
+            'Loading level {level_id}',
+            'debug',
+            level_id=level_id
+        )
+
+        if level_id in self.defined_levels.keys():
+            template = self.getTemplate(level_id)
+
+            if not template:
                 return False
-            except json.decoder.JSONDecodeError:
-                log(
-                    'WorldManager',
-                    f'Failed to parse {level_filename} (empty?)',
-                    'warning'
-                )
+
+            # Levels can be changed while they're loaded, so each gets its
+            #     own copy. Tiles are never changed, so they can be shared
+            level_data = copy.deepcopy(template['data'])
 
             self.levels[level_id] = level_data
             log('WorldManager', f'Loaded level {level_id}')
 
-            # If the level needs to be generated, generate it
-            if 'generator' in level_data['level'].keys():
-                self.generateLevel(level_data)
+            snapshot = self.level_snapshots.pop(level_id, None)
+
+            if snapshot and 'tiles' in snapshot.keys():
+                # The level has been generated before, so restore it
+                level_data['elements'] = snapshot['elements']
+
+                self.compileGrid(level_data, snapshot['tiles'])
+            elif 'generator' in level_data['level'].keys():
+                # If the level needs to be generated, generate it
+                tiles = self.generateLevel(level_data)
 
-            # Set up extra entity data
-            entity_manager.loadEntities(level_data)
+                if tiles is None:
+                    del self.levels[level_id]
+                    return False
+
+                self.compileGrid(level_data, tiles)
+            else:
+                self.compileGrid(level_data, template['tiles'])
+
+            # Set up extra entity data. Snapshots saved with the world (see
+            #     Snapshots) have the entities that were on the level
+            if snapshot and 'entities' in snapshot.keys():
+                level_data['entities'] = entity_manager.unpackEntities(
+                    snapshot['entities']
+                )
+            else:
+                entity_manager.loadEntities(level_data)
+
+            self.bucket_sizes[level_id] = max(1, entity_manager.max_range)
+            self.indexLevel(level_id)
+
+            # Levels start off asleep, until a player is linked to them
+            self.sleeping_levels[level_id] = self.clock()
 
             return True
 
         return False
 
+    # Generates the tiles of a level, and places its spawn point. Returns
+    #     the tiles as a grid of tileset codes, or None on failure
     def generateLevel(self, level):
-        if level['level']['generator'] == 'cave':
-            total_tiles = level['level']['width'] * level['level']['height']
-            fill_tiles = int(total_tiles / 3)  # How many tiles to generate
-
-            # Start in the middle of the level space
-            cur_x = int(level['level']['width'] / 2)
-            cur_y = int(level['level']['height'] / 2)
-
-            # Tiles that are allowed to be generated.
-            # Multiple entries are used as a simple weighting system for now
-            possible_tiles = [
-                'ground',
-                'ground',
-                'tall grass'
+        tileset = self.getTileset(level['level']['tileset'])
+
+        if not tileset:
+            return None
+
+        generated = self.generator.generate(level, tileset)
+
+        if not generated:
+            return None
+
+        if 'elements' not in level.keys():
+            level['elements'] = {}
+
+        level['elements']['spawn'] = generated['spawn']
+
+        return generated['tiles']
+
+    # Loads a tileset's mapping of tile types to codes. Returns None on
+    #     failure
+    def getTileset(self, tileset_id):
+        if tileset_id not in self.tilesets.keys():
+            filename = f'Game/data/tilesets/{tileset_id}.json'
+
+            try:
+                self.tilesets[tileset_id] = json.load(open(filename, 'r'))
+            except IOError:
+                log('WorldManager', f'Failed to open {filename}', 'error')
+                return None
+            except json.decoder.JSONDecodeError:
+                log(
+                    'WorldManager',
+                    f'Failed to parse {filename} (empty?)',
+                    'error'
+                )
+
+                return None
+
+        return self.tilesets[tileset_id]
+
+    # Converts the list of tile type strings of a level into a grid of
+    #     the codes of a tileset, and removes the strings. Returns None on
+    #     failure.
+    # Only reads the level and tileset it's given, so it's safe to run outside
+    #     the main thread
+    def tileCodes(self, level, tileset):
+        try:
+            tiles = array('B', [tileset[t] for t in level['level']['tiles']])
+        except KeyError as e:
+            log(
+                'WorldManager',
+                f'Tile type {e} is not in tileset {level["level"]["tileset"]}',
+                'error'
+            )
+
+            return None
+
+        # The grid is now the source of truth for the level's tiles
+        del level['level']['tiles']
+
+        return tiles
+
+    # Sets up the grid of a level from its tileset codes, precomputing which
+    #     tiles can be walked on and which have messages
+    def compileGrid(self, level, tiles):
+        tileset = self.getTileset(level['level']['tileset'])
+
+        # Lookup tables from tile code to tile properties
+        names = [None] * 256
+        messages = [None] * 256
+        walkable_table = bytearray(256)
+        message_table = bytearray(256)
+
+        for name, code in tileset.items():
+            names[code] = name
+
+            if name in self.tile_types.keys():
+                properties = self.tile_types[name]
+
+                if properties['walkable']:
+                    walkable_table[code] = 1
+
+                if 'message' in properties.keys():
+                    messages[code] = properties['message']
+                    message_table[code] = 1
+
+        # The version of a grid is a hash of its tiles, so a level that's
+        #     loaded again with the same tiles has the same version, and
+        #     clients that have seen it before don't need its tiles again
+        version = hashlib.sha1(tiles.tobytes())
+        version.update(json.dumps([level['level']['width'], names]).encode())
+
+        self.grids[level['id']] = {
+            'version': version.hexdigest()[:16],
+            'tiles': tiles,
+            'walkable': tiles.tobytes().translate(walkable_table),
+            'has message': tiles.tobytes().translate(message_table),
+            'names': names,
+            'messages': messages
+        }
+
+    # Returns a copy of a level that can be sent to clients. Tiles aren't
+    #     included, since they're sent separately (see getLevelTransfer).
+    # If visible is given, only entities with IDs in it are included
+    def getPublicLevel(self, level_id, visible=None):
+        level = self.levels[level_id]
+
+        public_level = level.copy()
+        public_level['level'] = level['level'].copy()
+
+        # Entities that are gone don't need to be sent
+        if 'entities' in level.keys():
+            public_level['entities'] = [
+                e.toDict() for e in level['entities']
+                if e.active and (visible is None or e.id in visible)
             ]
 
-            # Tiles where a spawn point could be placed
-            spawnable_tiles = []
+        return public_level
+
+    # Returns the tiles of a level encoded for sending to clients. They're
+    #     only encoded once for each version of the level's grid:
+    #     {'version', 'palette': tile code -> tile type, 'chunks': [...]}
+    # Tiles are split into chunks of whole rows, each sent as its own
+    #     message: {'level', 'version', 'chunk', 'start', 'encoding', 'data'}.
+    #     start is the index of the chunk's first tile. data is bytes, either
+    #     of tile codes ('codes') or of runs of tiles ('runs'): a tile code,
+    #     then how many times it repeats as a 16 bit little-endian number.
+    #     Runs are used if they're smaller
+    def getLevelTransfer(self, level_id):
+        grid = self.grids[level_id]
+        transfer = self.level_transfers.get(level_id)
+
+        if transfer and transfer['version'] == grid['version']:
+            return transfer
+
+        tiles = grid['tiles'].tobytes()
+        w = self.levels[level_id]['level']['width']
+
+        chunk_size = max(1, self.chunk_tiles // w) * w
+        chunks = []
 
-            # Create an empty level
-            level['level']['tiles'] = []
-            for i in range(0, total_tiles):
-                level['level']['tiles'].append('empty')
+        for start in range(0, len(tiles), chunk_size):
+            codes = tiles[start:start + chunk_size]
 
-            # Randomly create a floor space using a random walk algorithm
-            for i in range(0, fill_tiles):
-                # Choose a tile type to place
-                tile_type = random.randint(0, len(possible_tiles) - 1)
+            chunk = {
+                'level': level_id,
+                'version': grid['version'],
+                'chunk': len(chunks),
+                'start': start
+            }
 
-                tile_index = int(cur_y * level['level']['width'] + cur_x)
-                level['level']['tiles'][tile_index] = possible_tiles[tile_type]
+            # Each run takes 3 bytes
+            if self.countRuns(codes) * 3 < len(codes):
+                chunk['encoding'] = 'runs'
+                chunk['data'] = self.encodeRuns(codes)
+            else:
+                chunk['encoding'] = 'codes'
+                chunk['data'] = codes
 
-                spawnable_tiles.append({
-                    'x': cur_x,
-                    'y': cur_y
-                })
+            chunks.append(chunk)
+
+        transfer = {
+            'version': grid['version'],
+            'palette': grid['names'][:max(tiles) + 1] if tiles else [],
+            'chunks': chunks
+        }
 
-                # Move the "cursor" randomly until a suitable next spot to
-                #     place a tile is found
-                while True:
-                    if random.random() > 0.5:
-                        if random.random() > 0.5:
-                            cur_x += 1
-                        else:
-                            cur_x -= 1
-                    else:
-                        if random.random() > 0.5:
-                            cur_y += 1
-                        else:
-                            cur_y -= 1
+        self.level_transfers[level_id] = transfer
 
-                    if cur_x < 0 or cur_x >= level['level']['width'] or cur_y < 0 or cur_y >= level['level']['height']:  # noqa
-                        cur_x = int(level['level']['width'] / 2)
-                        cur_y = int(level['level']['height'] / 2)
+        return transfer
 
-                    if level['level']['tiles'][cur_y * level['level']['width'] + cur_x] == 'empty':  # noqa
-                        break
+    # Counts the runs of the same tile in a string of tile codes, by counting
+    #     the codes that differ from the one before. XORing the codes with
+    #     themselves shifted by one tile gives zero bytes where they're equal
+    def countRuns(self, codes):
+        if len(codes) < 2:
+            return len(codes)
 
-            # Place a spawn point somewhere random
-            spawn_tile = random.randint(0, len(spawnable_tiles) - 1)
+        n = len(codes) - 1
 
-            if 'elements' not in level.keys():
-                level['elements'] = {}
+        differences = (
+            int.from_bytes(codes[1:], 'little') ^
+            int.from_bytes(codes[:-1], 'little')
+        )
 
-            level['elements']['spawn'] = spawnable_tiles[spawn_tile]
+        return n - differences.to_bytes(n, 'little').count(0) + 1
+
+    # Run-length encodes a string of tile codes, as (code, 16 bit count)
+    #     triples
+    def encodeRuns(self, codes):
+        runs = bytearray()
+
+        for run in re.finditer(rb'(.)\1{0,65534}', codes, re.DOTALL):
+            length = run.end() - run.start()
+
+            runs.append(codes[run.start()])
+            runs.append(length & 0xFF)
+            runs.append(length >> 8)
+
+        return bytes(runs)
+
+    # Removes a level from memory, along with its entities
+    def unloadLevel(self, level_id, entity_manager):
+        level = self.levels.pop(level_id)
+
+        # Generated levels are remembered so that they don't change
+        if 'generator' in level['level'].keys():
+            self.level_snapshots[level_id] = {
+                'tiles': self.grids[level_id]['tiles'],
+                'elements': level['elements']
+            }
+
+        if 'entities' in level.keys():
+            for e in level['entities']:
+                entity_manager.removeEntity(e.id)
+
+        del self.grids[level_id]
+        self.level_transfers.pop(level_id, None)
+        del self.occupancy[level_id]
+        del self.free_tiles[level_id]
+        del self.populations[level_id]
+        del self.spawn_lists[level_id]
+        del self.buckets[level_id]
+        del self.bucket_sizes[level_id]
+        del self.level_players[level_id]
+
+        self.pathfinder.forgetLevel(level_id)
+
+        self.active_levels.pop(level_id, None)
+        self.sleeping_levels.pop(level_id, None)
+
+        log('WorldManager', f'Unloaded level {level_id}')
+
+    # Unloads sleeping levels that have been asleep for too long, or that are
+    #     the least recently used when too much is loaded. Levels in in_use
+    #     are never unloaded. Returns the IDs of unloaded levels
+    def evictLevels(self, entity_manager, in_use):
+        now = self.clock()
+        loaded_tiles = sum(len(g['tiles']) for g in self.grids.values())
+
+        evicted = []
+
+        for level_id, asleep_since in list(self.sleeping_levels.items()):
+            over_budget = (
+                len(self.levels) > self.max_loaded_levels or
+                loaded_tiles > self.max_loaded_tiles
+            )
+
+            if not over_budget and now - asleep_since < self.max_sleep_time:
+                # Later levels have been asleep for less time
+                break
+
+            if level_id in in_use:
+                continue
+
+            loaded_tiles -= len(self.grids[level_id]['tiles'])
+
+            self.unloadLevel(level_id, entity_manager)
+            evicted.append(level_id)
+
+        return evicted
 
     def levelLoaded(self, level_id):
         return level_id in self.levels.keys()
@@ -164,44 +582,43 @@ class WorldManager:
                 'message': 'You cannot move there'
             }
 
-        tile = self.levels[level_id]['level']['tiles'][y * w + x]
+        grid = self.grids[level_id]
+        tile_index = y * w + x
 
-        if tile in self.valid_movements:
-            message = None
+        message = None
 
-            if tile == 'tall grass':
-                message = 'You rustle through the tall grass'
+        if grid['has message'][tile_index]:
+            message = grid['messages'][grid['tiles'][tile_index]]
 
+        if grid['walkable'][tile_index]:
             # Check for entities on the tile
-            for e in self.levels[level_id]['entities']:
-                if not e['active']:
+            for e in self.entitiesAt(level_id, x, y):
+                if not e.active:
                     continue
 
-                if 'position' in e['components']:
-                    if e['components']['position']['x'] == x and e['components']['position']['y'] == y:  # noqa
-                        if 'type' in e and e['type'].split('.')[0] == 'monsters':  # noqa
-                            # Attacked a monster
-                            return {
-                                'success': False,
-                                'message': 'monster',
-                                'data': e
-                            }
-                        elif 'sid' in e['components']:
-                            # Player is being attacked
-                            return {
-                                'success': False,
-                                'message': 'player',
-                                'data': e
-                            }
+                if self.isMonster(e):
+                    # Attacked a monster
+                    return {
+                        'success': False,
+                        'message': 'monster',
+                        'data': e
+                    }
+                elif e.hasComponent('sid'):
+                    # Player is being attacked
+                    return {
+                        'success': False,
+                        'message': 'player',
+                        'data': e
+                    }
 
             return {
                 'success': True,
                 'message': message
             }
-        elif tile == 'wall':
+        elif message:
             return {
                 'success': False,
-                'message': 'You bump into the wall'
+                'message': message
             }
 
         return {
@@ -213,153 +630,530 @@ class WorldManager:
     # If there is more than one, just returns the first found
     def getTilePos(self, level_id, tile_type):
         level = self.levels[level_id]
+        tileset = self.getTileset(level['level']['tileset'])
 
-        for x in range(0, level['level']['width'] - 1):
-            for y in range(0, level['level']['height'] - 1):
-                if level['level']['tiles'][(y * level['level']['width'] + x)] == tile_type:  # noqa
-                    return {
-                        'x': x,
-                        'y': y
-                    }
+        if tile_type not in tileset.keys():
+            return None
+
+        try:
+            tile_index = self.grids[level_id]['tiles'].index(tileset[tile_type])  # noqa
+        except ValueError:
+            return None
+
+        return {
+            'x': tile_index % level['level']['width'],
+            'y': tile_index // level['level']['width']
+        }
 
-    # Finds a random valid spawn location in a level
+    # Finds a random valid spawn location in a level, where nobody is
+    #     standing. Returns None if there are none
     def getRandomSpawn(self, level):
-        valid_tiles = []
+        free = self.free_tiles[level['id']]['tiles']
 
-        for x in range(0, level['level']['width'] - 1):
-            for y in range(0, level['level']['height'] - 1):
-                try:
-                    for e in level['entities']:
-                        if e['components']['position']['x'] == x and e['components']['position']['y'] == y:  # noqa
-                            continue
-                except KeyError:
-                    pass
+        if not free:
+            return None
 
-                if level['level']['tiles'][(y * level['level']['width'] + x)] in self.valid_movements:  # noqa
-                    valid_tiles.append({
-                        'x': x,
-                        'y': y
-                    })
+        tile_index = free[self.rng.randrange(0, len(free))]
 
-        return_index = random.randint(0, len(valid_tiles) - 1)
-        return valid_tiles[return_index]
+        return {
+            'x': tile_index % level['level']['width'],
+            'y': tile_index // level['level']['width']
+        }
 
     # Spawn monsters in levels where monster levels are depleted
     def spawnMonsters(self, entity_manager):
-        for level_id in self.levels.keys():
-            l = self.levels[level_id]  # noqa
+        for level_id in self.active_levels.keys():
+            self.spawnLevelMonsters(level_id, entity_manager)
 
-            if 'monsters' in l.keys():
-                for m in l['monsters']:
-                    current_n = 0
+    # Spawns monsters of each type that a level is short of. Usually only one
+    #     of each type is spawned at a time, but if fill is set, every missing
+    #     monster is spawned at once
+    def spawnLevelMonsters(self, level_id, entity_manager, fill=False):
+        l = self.levels[level_id]  # noqa
+        population = self.populations[level_id]
+
+        for entity_type, max_n in self.spawn_lists[level_id]:
+            to_spawn = max_n - population.get(entity_type, 0)
 
-                    if 'entities' in l.keys():
-                        for e in l['entities']:
-                            if ('type' not in e.keys()) or (not e['active']):
-                                continue
+            if not fill:
+                to_spawn = min(to_spawn, 1)
 
-                            if e['type'] == ('monsters.' + m['type']):
-                                current_n += 1
+            for i in range(0, to_spawn):
+                spawn = self.getRandomSpawn(l)
 
-                    if current_n < m['max_n']:
-                        e = {}
+                # The level is full
+                if not spawn:
+                    return
+
+                e = {
+                    'type': entity_type,
+                    'components': {
+                        'position': spawn
+                    }
+                }
 
-                        e['type'] = 'monsters.' + m['type']
-                        e['components'] = {
-                            'position': self.getRandomSpawn(l)
-                        }
-                        e['new'] = True
+                if 'entities' not in l.keys():
+                    l['entities'] = []
 
-                        l['entities'].append(e)
-                        entity_manager.loadNewEntities(l)
+                e = entity_manager.loadEntity(e)
 
-                        log(
-                            'WorldManager',
-                            'Spawned a ' + e['type'] + ' to level ' + l['title'],  # noqa
-                            'debug'
-                        )
+                l['entities'].append(e)
+                self.placeEntity(level_id, e)
+
+                log(
+                    'WorldManager',
+                    'Spawned a {entity_type} to level {title}',
+                    'debug',
+                    entity_type=entity_type,
+                    title=l['title']
+                )
+
+    # Levels are only simulated while they're awake (i.e. while there are
+    #     players on them). Since nothing happens on a level while it's
+    #     asleep, it catches up roughly when it wakes up
+    def wakeLevel(self, level_id, entity_manager):
+        if level_id in self.active_levels.keys():
+            return
+
+        self.active_levels[level_id] = True
+        self.sleeping_levels.pop(level_id, None)
+        log(
+            'WorldManager',
+            'Level {level_id} woke up',
+            'debug',
+            level_id=level_id
+        )
+
+        self.spawnLevelMonsters(level_id, entity_manager, fill=True)
+
+        # Players on this level might soon head down the stairs, so get the
+        #     level they lead to ready
+        elements = self.levels[level_id].get('elements', {})
+
+        if 'stairs down' in elements.keys():
+            self.queuePreload(elements['stairs down']['target'])
+
+    def sleepLevel(self, level_id):
+        if level_id in self.active_levels.keys():
+            del self.active_levels[level_id]
+            self.sleeping_levels[level_id] = self.clock()
+            log(
+                'WorldManager',
+                'Level {level_id} went to sleep',
+                'debug',
+                level_id=level_id
+            )
 
     def updateMonsters(self, entity_manager, combat_manager):
-        for level_id in self.levels.keys():
-            l = self.levels[level_id]  # noqa
-
-            if 'entities' in l.keys():
-                for e in l['entities']:
-                    try:
-                        # Entities in combat don't move freely
-                        if 'combat' in e.keys():
-                            if e['combat']['in_combat']:
-                                continue
-
-                        if e['components']['movement'] and e['active']:
-                            entity_manager.entityMakeMove(
-                                e['id'],
-                                level_id,
-                                self,
-                                combat_manager
-                            )
-                    except KeyError:
-                        pass
+        store = entity_manager.store
+        mask = store.POSITION | store.MOVEMENT
+
+        for level_id in self.active_levels.keys():
+            rows = [
+                row for row in store.query(level_id, mask)
+                # Entities in combat don't move freely
+                if not (
+                    store.records[row].combat and
+                    store.records[row].combat['in_combat']
+                )
+            ]
+
+            self.moveMonsters(level_id, rows, entity_manager, combat_manager)
+
+    # Moves a batch of monsters on a level (given as rows in the entity
+    #     store) a step each, all at once. Each monster picks a random tile
+    #     next to it that can be walked on and has no monster on it, or a
+    #     player to attack. Monsters that chase, and are in combat, only pick
+    #     from the tiles that get them closest to their opponent.
+    # Every monster looks at the level as it was before any of them moved.
+    #     When two pick the same tile, the first one gets it and the other
+    #     stays put
+    def moveMonsters(self, level_id, rows, entity_manager, combat_manager):
+        if not rows:
+            return
+
+        store = entity_manager.store
+
+        w = self.levels[level_id]['level']['width']
+        h = self.levels[level_id]['level']['height']
+
+        walkable = self.grids[level_id]['walkable']
+        occupancy = self.occupancy[level_id]
 
+        # Players that can be chased. SID -> entity
+        opponents = {
+            p.getComponent('sid')['sid']: p
+            for p in self.level_players[level_id].values()
+        }
+
+        claimed = set()  # Tiles that monsters are moving onto
+        steps = []  # (monster, tile, defender)
+
+        for row in rows:
+            if not store.active[row]:
+                continue
+
+            e = store.records[row]
+            x = store.x[row]
+            y = store.y[row]
+
+            # (tile index, player on the tile or None)
+            options = []
+
+            for dx, dy in self.directions:
+                tile_x = x + dx
+                tile_y = y + dy
+
+                if tile_x < 0 or tile_x >= w or tile_y < 0 or tile_y >= h:
+                    continue
+
+                tile_index = tile_y * w + tile_x
+
+                if not walkable[tile_index]:
+                    continue
+
+                defender = None
+                blocked = False
+
+                if tile_index in occupancy:
+                    for occupant in occupancy[tile_index].values():
+                        if not occupant.active:
+                            continue
+
+                        if self.isMonster(occupant):
+                            blocked = True
+                            break
+                        elif occupant.hasComponent('sid'):
+                            defender = occupant
+                            break
+
+                if not blocked:
+                    options.append((tile_index, defender))
+
+            if e.movement == 'random/chase' and e.combat:
+                target = opponents.get(e.combat.get('opponent'))
+
+                if target and options:
+                    options = self.closestOptions(
+                        level_id,
+                        options,
+                        target
+                    )
+
+            # Boxed in, so stay put
+            if not options:
+                continue
+
+            tile_index, defender = options[self.rng.randrange(0, len(options))]
+
+            if defender is None:
+                if tile_index in claimed:
+                    continue
+
+                claimed.add(tile_index)
+
+            steps.append((e, tile_index, defender))
+
+        for e, tile_index, defender in steps:
+            if defender is None:
+                self.moveEntity(level_id, e, {
+                    'x': tile_index % w,
+                    'y': tile_index // w
+                })
+            elif defender.active:
+                # The monster has attacked a player
+                combat_manager.attack(e, defender)
+
+                if not defender.active:
+                    self.unplaceEntity(level_id, defender)
+
+    # Of the tiles that a monster could step onto, returns those that are the
+    #     fewest steps from a target entity. Steps are counted around walls
+    #     with the target's flow field. Tiles outside of the field are only
+    #     picked if none are inside it, and then by how far they are in a
+    #     straight line
+    def closestOptions(self, level_id, options, target):
+        w = self.levels[level_id]['level']['width']
+        h = self.levels[level_id]['level']['height']
+
+        field = self.pathfinder.getField(
+            level_id,
+            target,
+            self.grids[level_id]['walkable'],
+            w,
+            h
+        )
+
+        distances = []
+
+        for tile_index, defender in options:
+            x = tile_index % w
+            y = tile_index // w
+
+            distance = self.pathfinder.distance(field, x, y)
+
+            if distance is None:
+                distance = self.pathfinder.unreachable + max(
+                    abs(x - target.x),
+                    abs(y - target.y)
+                )
+
+            distances.append(distance)
+
+        closest = min(distances)
+
+        return [
+            options[i] for i in range(0, len(options))
+            if distances[i] == closest
+        ]
+
+    # Starts combat between monsters and players that are close enough
+    def updateCombat(self):
+        for level_id in self.active_levels.keys():
             self.checkForCombat(level_id)
 
+    # Starts combat between monsters and players that are in range of them.
+    # If given a specific player, only checks monsters near that player, and
+    #     monsters that are already in combat can switch to them
     def checkForCombat(self, level_id, entity=None):
-        l = self.levels[level_id]  # noqa
+        if entity:
+            players = [entity]
+        else:
+            players = list(self.level_players[level_id].values())
+
+        for player in players:
+            store = player.store
+            x = player.x
+            y = player.y
+
+            for e in self.entitiesNear(level_id, x, y):
+                row = e.row
+
+                if not store.mask[row] & store.RANGE or not self.isMonster(e):
+                    continue
 
-        if 'entities' in l.keys():
-            for e in l['entities']:
                 # If a monster is already in combat, ignore it--unless we're
-                #     given a specific entity to check, since it can take
-                #     the aggro
-                if (not entity) and ('combat' in e.keys()):
-                    if e['combat']['in_combat']:
+                #     given a specific entity to check, since it can take the
+                #     aggro
+                if (not entity) and e.combat:
+                    if e.combat['in_combat']:
                         continue
 
-                try:
-                    if 'range' not in e['components'].keys():
-                        continue
+                dx = store.x[row] - x
+                dy = store.y[row] - y
+
+                if dx * dx + dy * dy <= store.range[row]**2:
+                    e.combat = {
+                        'in_combat': True,
+                        'opponent': player.getComponent('sid')['sid']
+                    }
+
+                    player.combat = {
+                        'in_combat': True
+                    }
+
+    # Returns the entities in the bucket of a position and the buckets around
+    #     it
+    def entitiesNear(self, level_id, x, y):
+        size = self.bucket_sizes[level_id]
+        buckets = self.buckets[level_id]
+
+        bucket_x = x // size
+        bucket_y = y // size
+
+        entities = []
+
+        for i in range(bucket_x - 1, bucket_x + 2):
+            for j in range(bucket_y - 1, bucket_y + 2):
+                if (i, j) in buckets:
+                    entities.extend(buckets[(i, j)].values())
+
+        return entities
+
+    # Returns the entities within a square around a position, as entity ID ->
+    #     entity
+    def entitiesWithin(self, level_id, x, y, radius):
+        size = self.bucket_sizes[level_id]
+        buckets = self.buckets[level_id]
+
+        found = {}
+
+        for i in range((x - radius) // size, (x + radius) // size + 1):
+            for j in range((y - radius) // size, (y + radius) // size + 1):
+                if (i, j) not in buckets:
+                    continue
+
+                for ent_id, e in buckets[(i, j)].items():
+                    if abs(e.x - x) <= radius and abs(e.y - y) <= radius:
+                        found[ent_id] = e
+
+        return found
+
+    # Entities with a "monsters.*" type are monsters
+    def isMonster(self, entity):
+        return entity.type is not None and entity.type.startswith('monsters.')
+
+    # Rebuilds the occupancy index of a level from its list of entities
+    def indexLevel(self, level_id):
+        self.occupancy[level_id] = {}
+        self.populations[level_id] = {}
+        self.buckets[level_id] = {}
+        self.level_players[level_id] = {}
+
+        self.spawn_lists[level_id] = [
+            ('monsters.' + m['type'], m['max_n'])
+            for m in self.levels[level_id].get('monsters', [])
+        ]
+
+        # Every walkable tile starts off free
+        walkable = self.grids[level_id]['walkable']
+        free = array('I', [i for i in range(0, len(walkable)) if walkable[i]])
+        positions = array('i', [-1]) * len(walkable)
+
+        for i in range(0, len(free)):
+            positions[free[i]] = i
+
+        self.free_tiles[level_id] = {
+            'tiles': free,
+            'positions': positions
+        }
+
+        if 'entities' in self.levels[level_id].keys():
+            for e in self.levels[level_id]['entities']:
+                self.placeEntity(level_id, e)
+
+    # Returns the entities standing on a tile, according to the index
+    def entitiesAt(self, level_id, x, y):
+        tile_index = y * self.levels[level_id]['level']['width'] + x
+        occupants = self.occupancy[level_id].get(tile_index)
+
+        if occupants:
+            return list(occupants.values())
+
+        return []
+
+    # Adds an entity to the occupancy index at its current position, and
+    #     counts it in the level's population.
+    # Inactive entities and entities without a position aren't indexed
+    def placeEntity(self, level_id, entity):
+        entity.level = level_id
+
+        if not entity.active or not entity.hasComponent('position'):
+            return
+
+        self.occupyTile(level_id, entity)
+
+        if entity.type is not None:
+            population = self.populations[level_id]
+            population[entity.type] = population.get(entity.type, 0) + 1
+
+        if entity.hasComponent('sid'):
+            self.level_players[level_id][entity.id] = entity
+
+    # Removes an entity from the occupancy index and the level's population.
+    # Must be called before the entity's position is changed, or when it
+    #     leaves the level or dies
+    def unplaceEntity(self, level_id, entity):
+        if not entity.hasComponent('position'):
+            return
+
+        if not self.vacateTile(level_id, entity):
+            return
+
+        if entity.type is not None:
+            self.populations[level_id][entity.type] -= 1
+
+        self.level_players[level_id].pop(entity.id, None)
+        self.pathfinder.forgetEntity(level_id, entity.id)
+
+    # Moves an entity to a new position on a level, keeping the occupancy
+    #     index up to date
+    def moveEntity(self, level_id, entity, coords):
+        indexed = self.vacateTile(level_id, entity)
+
+        entity.x = coords['x']
+        entity.y = coords['y']
+
+        # Mark the position as changed, so that it will be sent to users
+        entity.markDirty('position')
+
+        if indexed:
+            self.occupyTile(level_id, entity)
+
+    # Puts an entity on the tile at its position in the occupancy index, and
+    #     in the bucket that tile is in
+    def occupyTile(self, level_id, entity):
+        x = entity.x
+        y = entity.y
+        tile_index = y * self.levels[level_id]['level']['width'] + x
+
+        if tile_index not in self.occupancy[level_id]:
+            self.occupancy[level_id][tile_index] = {}
+            self.takeFreeTile(level_id, tile_index)
+
+        self.occupancy[level_id][tile_index][entity.id] = entity
+
+        size = self.bucket_sizes[level_id]
+        bucket = (x // size, y // size)
+
+        if bucket not in self.buckets[level_id]:
+            self.buckets[level_id][bucket] = {}
+
+        self.buckets[level_id][bucket][entity.id] = entity
+
+    # Takes an entity off the tile at its position in the occupancy index.
+    # Returns whether it was there
+    def vacateTile(self, level_id, entity):
+        x = entity.x
+        y = entity.y
+        tile_index = y * self.levels[level_id]['level']['width'] + x
+        occupants = self.occupancy[level_id].get(tile_index)
+
+        if not occupants or entity.id not in occupants:
+            return False
+
+        del occupants[entity.id]
+
+        if not occupants:
+            del self.occupancy[level_id][tile_index]
+            self.releaseFreeTile(level_id, tile_index)
+
+        size = self.bucket_sizes[level_id]
+        bucket = (x // size, y // size)
+        entities = self.buckets[level_id][bucket]
+
+        del entities[entity.id]
+
+        if not entities:
+            del self.buckets[level_id][bucket]
+
+        return True
+
+    # Removes a tile from the free tiles of a level, by swapping the last free
+    #     tile into its place
+    def takeFreeTile(self, level_id, tile_index):
+        free = self.free_tiles[level_id]
+        position = free['positions'][tile_index]
+
+        if position == -1:
+            return
+
+        last = free['tiles'][-1]
+        free['tiles'][position] = last
+        free['positions'][last] = position
+
+        free['tiles'].pop()
+        free['positions'][tile_index] = -1
+
+    # Adds a tile back to the free tiles of a level, if it can be walked on
+    def releaseFreeTile(self, level_id, tile_index):
+        free = self.free_tiles[level_id]
+
+        if free['positions'][tile_index] != -1:
+            return
+
+        if not self.grids[level_id]['walkable'][tile_index]:
+            return
 
-                    if e['active'] and e['type'].split('.')[0] == 'monsters':
-                        # If given a specific entity, just check if that one is
-                        #     involved in combat
-                        if entity:
-                            pos1 = e['components']['position']
-                            pos2 = entity['components']['position']
-
-                            distance = math.sqrt(
-                                (pos1['x'] - pos2['x'])**2 +
-                                (pos1['y'] - pos2['y'])**2
-                            )
-
-                            if distance <= e['components']['range']:
-                                e['combat'] = {
-                                    'in_combat': True,
-                                    'opponent': entity['components']['sid']['sid']  # noqa
-                                }
-
-                                entity['combat'] = {
-                                    'in_combat': True
-                                }
-
-                        else:
-                            for e2 in l['entities']:
-                                if e2['active'] and 'sid' in e2['components'].keys():  # noqa
-                                    pos1 = e['components']['position']
-                                    pos2 = e2['components']['position']
-
-                                    distance = math.sqrt(
-                                        (pos1['x'] - pos2['x'])**2 +
-                                        (pos1['y'] - pos2['y'])**2
-                                    )
-
-                                    if distance <= e['components']['range']:
-                                        e['combat'] = {
-                                            'in_combat': True,
-                                            'opponent': e2['components']['sid']['sid']  # noqa
-                                        }
-
-                                        e2['combat'] = {
-                                            'in_combat': True
-                                        }
-                except KeyError:
-                    pass
+        free['positions'][tile_index] = len(free['tiles'])
+        free['tiles'].append(tile_index)
@@ -0,0 +1,50 @@
+# Measures how long level generators take for square maps of various sizes.
+# Run from the root of the repository:
+#     python -m benchmarks.generators [generator] [seed]
+from Game import WorldManager
+
+import sys
+import time
+
+
+sizes = [100, 250, 500, 750, 1000]
+
+
+def benchmark(generator='cave', seed=1, repeats=3):
+    world_manager = WorldManager.WorldManager()
+    tileset = world_manager.getTileset('cave')
+
+    print(f'Generator: {generator}, seed: {seed}')
+    print(f'{"size":>11} {"tiles":>9} {"best (s)":>9} {"us/tile":>8}')
+
+    for size in sizes:
+        times = []
+
+        for i in range(0, repeats):
+            level = {
+                'level': {
+                    'width': size,
+                    'height': size,
+                    'generator': generator,
+                    'seed': seed
+                }
+            }
+
+            start = time.perf_counter()
+            world_manager.generator.generate(level, tileset)
+            times.append(time.perf_counter() - start)
+
+        tiles = size * size
+        best = min(times)
+
+        print(
+            f'{f"{size}x{size}":>11} {tiles:>9} {best:>9.3f} \
+{best / tiles * 1000000:>8.3f}'
+        )
+
+
+if __name__ == '__main__':
+    generator = sys.argv[1] if len(sys.argv) > 1 else 'cave'
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+
+    benchmark(generator, seed)
@@ -0,0 +1,690 @@
+# Simulates players logging in, walking around, taking stairs and fighting,
+#     and measures what that costs the server: how long ticks take, how much
+#     is emitted, how many bytes each player is sent, and how much memory
+#     each entity takes.
+# The world can be driven directly (the default), running a Manager in this
+#     process with no networking, or through a swarm of socket.io clients
+#     connected to server.py (--swarm), which is started for the run unless
+#     --url is given. The swarm needs python-socketio's client dependencies
+#     (requests and websocket-client).
+# Players start spread across the levels given (--levels). Levels named
+#     "large:<size>" are made up for the run: generated square caves of that
+#     size, full of monsters.
+# Results are written as JSON, so that they can be kept as a baseline and
+#     compared against later (--baseline). Run from the root of the
+#     repository:
+#     python -m benchmarks.load [--players N] [--ticks N] [--output FILE]
+#     python -m benchmarks.load --swarm [--url URL] [--duration SECONDS]
+import log
+from Game import Handlers
+from Game import Manager
+from Game import Pathfinder
+from Game import Scheduler
+
+import argparse
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import tracemalloc
+
+
+default_levels = [
+    'beginner dungeon 1',
+    'beginner dungeon 2',
+    'beginner dungeon 3',
+    'large:200'
+]
+
+# Directions that a move can be in, by their offsets
+directions = {
+    (-1, 1): '1', (0, 1): '2', (1, 1): '3',
+    (-1, 0): '4', (1, 0): '6',
+    (-1, -1): '7', (0, -1): '8', (1, -1): '9'
+}
+
+
+# Returns roughly how many bytes an emit takes on the wire. Socket.io sends
+#     events as JSON, with any bytes in them sent separately as binary
+#     attachments
+def payloadSize(event, data=None):
+    attachments = []
+
+    def placeholder(value):
+        if isinstance(value, (bytes, bytearray)):
+            attachments.append(len(value))
+            return {'_placeholder': True, 'num': len(attachments) - 1}
+
+        raise TypeError(f'{type(value)} can\'t be sent')
+
+    packet = [event] if data is None else [event, data]
+    encoded = json.dumps(packet, separators=(',', ':'), default=placeholder)
+
+    return len(encoded) + sum(attachments)
+
+
+# Summarizes a list of durations (in seconds) in milliseconds, the same way
+#     as the scheduler's stats
+def summarize(durations):
+    summary = Scheduler.Scheduler(None).summarize(durations)
+    summary['mean'] = sum(durations) / len(durations) * 1000 if durations else 0  # noqa
+
+    return summary
+
+
+# Counts the emits for each event, and the bytes sent to each player.
+#     Stands in for a socketio.Server when the world is driven directly
+class CountingSio:
+    def __init__(self):
+        self.rooms = {}  # Room -> set of SIDs
+
+        self.events = {}  # Event -> {'count', 'bytes'}
+        self.received = {}  # SID -> bytes sent to them
+        self.messages = 0  # Emits multiplied by who they're sent to
+
+    def emit(self, event, data=None, room=None):
+        size = payloadSize(event, data)
+
+        if event not in self.events.keys():
+            self.events[event] = {'count': 0, 'bytes': 0}
+
+        self.events[event]['count'] += 1
+        self.events[event]['bytes'] += size
+
+        # Rooms that aren't level rooms are SIDs
+        recipients = self.rooms.get(room, [room])
+
+        for sid in recipients:
+            self.received[sid] = self.received.get(sid, 0) + size
+
+        self.messages += len(recipients)
+
+    def enter_room(self, sid, room):
+        if room not in self.rooms.keys():
+            self.rooms[room] = set()
+
+        self.rooms[room].add(sid)
+
+    def leave_room(self, sid, room):
+        self.rooms.get(room, set()).discard(sid)
+
+
+# Adds a made up level to a world: a generated square cave of a size, with
+#     one monster for every 50 or so tiles. Returns its ID
+def addLargeLevel(world_manager, size, seed=1, monsters=None):
+    level_id = f'large:{size}'
+
+    if monsters is None:
+        monsters = size * size // 50
+
+    level = {
+        'id': level_id,
+        'title': f'Large Cave ({size}x{size})',
+        'level': {
+            'width': size,
+            'height': size,
+            'tile_width': 15,
+            'tile_height': 15,
+            'camera_zoom': 2,
+            'tileset': 'cave',
+            'generator': 'cave',
+            'seed': seed
+        },
+        'monsters': [
+            {'type': 'floating paper (strange)', 'max_n': monsters // 2},
+            {
+                'type': 'floating paper (aggressive)',
+                'max_n': monsters - monsters // 2
+            }
+        ]
+    }
+
+    # There's no file to read, since the template is already there
+    world_manager.defined_levels[level_id] = None
+    world_manager.level_templates[level_id] = {'data': level, 'tiles': None}
+
+    return level_id
+
+
+# Finds the way to the stairs for bots
+pathfinder = Pathfinder.Pathfinder()
+
+
+# A simulated player in a world that's driven directly. Heads for the stairs
+#     down when there are some, fights monsters that are nearby or in the
+#     way, and otherwise wanders around
+class Bot:
+    def __init__(self, sid, rng):
+        self.sid = sid
+        self.rng = rng
+
+        self.level_id = None
+        self.held = {}  # Level ID -> version of the tiles the bot has
+
+    # Returns the action the bot takes this tick, as (action type, details),
+    #     or None. stairs has the stairs down of each level that has some,
+    #     as level ID -> (x, y, flow field)
+    def act(self, manager, stairs):
+        player = manager.players.get(self.sid)
+
+        if not player:
+            return None
+
+        ent = manager.EntityManager.getEntity(player['entity'])
+
+        if not ent.active:
+            return None
+
+        level_id = player['on level']
+        world_manager = manager.WorldManager
+
+        if level_id in stairs.keys() and (ent.x, ent.y) == stairs[level_id][:2]:  # noqa
+            return ('stairs down', {})
+
+        # Fight the closest monster, if there's one close by
+        nearby = world_manager.entitiesWithin(level_id, ent.x, ent.y, 6)
+        closest = None
+
+        for e in nearby.values():
+            if not e.active or not world_manager.isMonster(e):
+                continue
+
+            distance = max(abs(e.x - ent.x), abs(e.y - ent.y))
+
+            if not closest or distance < closest[0]:
+                closest = (distance, e.x, e.y)
+
+        if self.rng.random() < 0.2:
+            return ('move', {'dir': self.rng.choice('12346789')})
+
+        if closest and (level_id not in stairs.keys() or closest[0] <= 2):
+            dx = (closest[1] > ent.x) - (closest[1] < ent.x)
+            dy = (closest[2] > ent.y) - (closest[2] < ent.y)
+
+            return ('move', {'dir': directions[(dx, dy)]})
+
+        if level_id not in stairs.keys():
+            return ('move', {'dir': self.rng.choice('12346789')})
+
+        # Follow the way to the stairs
+        x, y, field = stairs[level_id]
+        best = None
+
+        for (dx, dy), direction in directions.items():
+            distance = pathfinder.distance(field, ent.x + dx, ent.y + dy)
+
+            if distance is not None and (not best or distance < best[0]):
+                best = (distance, direction)
+
+        if not best:
+            return ('move', {'dir': self.rng.choice('12346789')})
+
+        return ('move', {'dir': best[1]})
+
+
+# Drives a world directly, without networking
+def runDirect(players, ticks, levels, seed=1, tick_rate=1):
+    manager = Manager.Manager(seed)
+    world_manager = manager.WorldManager
+
+    # Time only passes between ticks, as it would on a server
+    now = [time.monotonic()]
+    world_manager.clock = lambda: now[0]
+
+    for i, level_id in enumerate(levels):
+        if level_id.startswith('large:'):
+            levels[i] = addLargeLevel(world_manager, int(level_id[6:]), seed)
+
+    sio = CountingSio()
+    handlers = Handlers.Handlers(manager, sio)
+
+    scheduler = Scheduler.Scheduler(None, tick_rate, window=ticks)
+    scheduler.addPhase('spawn', manager.updateSpawns)
+    scheduler.addPhase('ai', manager.updateAI)
+    scheduler.addPhase('combat', manager.updateCombat)
+    scheduler.addPhase('evict', manager.updateEviction)
+    scheduler.addPhase('emit', lambda: manager.emitUpdates(sio))
+
+    rng = random.Random(seed)
+    bots = []
+    login_durations = []
+
+    for i in range(0, players):
+        bot = Bot(f'bot{i}', random.Random(rng.getrandbits(32)))
+
+        start = time.perf_counter()
+        handlers.login(bot.sid, bot.sid, levels[i % len(levels)])
+        handlers.requestPresentLevel(bot.sid, bot.held)
+        login_durations.append(time.perf_counter() - start)
+
+        bot.level_id = manager.players[bot.sid]['on level']
+        bot.held[bot.level_id] = world_manager.grids[bot.level_id]['version']
+
+        bots.append(bot)
+
+    # Where the stairs down of each level are, looked up once per level
+    stairs = {}
+
+    action_durations = []
+    level_changes = 0
+
+    for tick in range(0, ticks):
+        now[0] += 1 / tick_rate
+
+        for level_id in world_manager.levels.keys():
+            if level_id not in stairs.keys():
+                position = world_manager.getTilePos(level_id, 'stairs down')
+
+                if position:
+                    level = world_manager.getLevel(level_id)['level']
+
+                    stairs[level_id] = (
+                        position['x'],
+                        position['y'],
+                        pathfinder.makeField(
+                            position['x'],
+                            position['y'],
+                            world_manager.grids[level_id]['walkable'],
+                            level['width'],
+                            level['height']
+                        )
+                    )
+
+        for bot in bots:
+            action = bot.act(manager, stairs)
+
+            if not action:
+                continue
+
+            start = time.perf_counter()
+            handlers.action(bot.sid, *action)
+
+            # Clients ask for the level they're on when they change level
+            if manager.players[bot.sid]['on level'] != bot.level_id:
+                level_changes += 1
+                bot.level_id = manager.players[bot.sid]['on level']
+                handlers.requestPresentLevel(bot.sid, bot.held)
+
+                bot.held[bot.level_id] = world_manager.grids[bot.level_id]['version']  # noqa
+
+            action_durations.append(time.perf_counter() - start)
+
+        scheduler.tick()
+
+    stats = scheduler.stats()
+    received = list(sio.received.values())
+    store = manager.EntityManager.store
+
+    alive = 0
+
+    for bot in bots:
+        player = manager.players.get(bot.sid)
+
+        if player and manager.EntityManager.getEntity(player['entity']).active:  # noqa
+            alive += 1
+
+    return {
+        'ticks': dict(summarize(scheduler.tick_durations), count=ticks),
+        'phases': stats['phases'],
+        'logins': summarize(login_durations),
+        'actions': dict(
+            summarize(action_durations),
+            count=len(action_durations)
+        ),
+        'emits': {
+            'count': sum(e['count'] for e in sio.events.values()),
+            'bytes': sum(e['bytes'] for e in sio.events.values()),
+            'messages': sio.messages,
+            'events': sio.events
+        },
+        'per_player': {
+            'bytes': sum(received) / players if players else 0,
+            'bytes_per_tick': sum(received) / players / ticks if players and ticks else 0,  # noqa
+            'max_bytes': max(received) if received else 0
+        },
+        'world': {
+            'levels': len(world_manager.levels),
+            'entities': sum(store.active[row] for row in store.rows.values()),  # noqa
+            'level_changes': level_changes,
+            'players_alive': alive
+        }
+    }
+
+
+# Measures how much memory entities take, by filling a large level with
+#     monsters
+def measureMemory(entities, seed=1):
+    manager = Manager.Manager(seed)
+    world_manager = manager.WorldManager
+    entity_manager = manager.EntityManager
+
+    # The level has room for every monster, with space to spare
+    size = math.ceil(math.sqrt(entities * 3))
+    level_id = addLargeLevel(world_manager, size, seed, entities)
+
+    world_manager.loadLevel(level_id, entity_manager)
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    world_manager.spawnLevelMonsters(level_id, entity_manager, fill=True)
+
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    count = len(world_manager.levels[level_id].get('entities', []))
+
+    return {
+        'entities': count,
+        'bytes_per_entity': (after - before) / count if count else 0
+    }
+
+
+# Starts server.py on a free port. Returns the process and its URL
+def startServer(tick_rate):
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        port = s.getsockname()[1]
+
+    env = dict(os.environ)
+    env['PORT'] = str(port)
+    env['TICK_RATE'] = str(tick_rate)
+    env.setdefault('LOG_LEVEL', 'warning')
+
+    process = subprocess.Popen([sys.executable, 'server.py'], env=env)
+
+    # Wait for it to start listening
+    deadline = time.monotonic() + 30
+
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('localhost', port), 1).close()
+            return process, f'http://localhost:{port}'
+        except OSError:
+            if process.poll() is not None:
+                break
+
+            time.sleep(0.2)
+
+    process.kill()
+    raise RuntimeError('server.py didn\'t start')
+
+
+# A simulated player connected to a server. Only knows what it's sent, so it
+#     wanders around, fighting whatever it bumps into, and tries the stairs
+#     now and then
+class SwarmClient:
+    events = [
+        'login success',
+        'msg',
+        'present level',
+        'level chunk',
+        'level change',
+        'level update',
+        'stats'
+    ]
+
+    def __init__(self, index, url, rng):
+        import socketio
+
+        self.index = index
+        self.url = url
+        self.rng = rng
+
+        self.received = {}  # Event -> {'count', 'bytes'}
+        self.held = {}  # Level ID -> version of the tiles the client has
+
+        self.login_start = None
+        self.login_duration = None
+        self.stats = None
+
+        self.client = socketio.Client(reconnection=False)
+
+        for event in self.events:
+            self.client.on(event, self.handler(event))
+
+    def handler(self, event):
+        def handle(data=None):
+            if event not in self.received.keys():
+                self.received[event] = {'count': 0, 'bytes': 0}
+
+            self.received[event]['count'] += 1
+            self.received[event]['bytes'] += payloadSize(event, data)
+
+            if event == 'login success':
+                self.login_duration = time.perf_counter() - self.login_start
+                self.client.emit('request present level')
+            elif event == 'present level':
+                self.held[data['id']] = data['transfer']['version']
+            elif event == 'level change':
+                self.client.emit('request present level', self.held)
+            elif event == 'stats':
+                self.stats = data
+
+        return handle
+
+    def connect(self):
+        self.client.connect(self.url)
+
+        self.login_start = time.perf_counter()
+        self.client.emit('login', f'swarm{self.index}')
+
+    def act(self):
+        if self.rng.random() < 0.05:
+            self.client.emit('action', ('stairs down', {}))
+        else:
+            self.client.emit(
+                'action',
+                ('move', {'dir': self.rng.choice('12346789')})
+            )
+
+    def disconnect(self):
+        self.client.disconnect()
+
+
+# Drives a server through socket.io clients, each sending a number of
+#     actions per second
+def runSwarm(url, players, duration, actions_per_second=4, seed=1):
+    rng = random.Random(seed)
+
+    clients = [
+        SwarmClient(i, url, random.Random(rng.getrandbits(32)))
+        for i in range(0, players)
+    ]
+
+    for client in clients:
+        client.connect()
+
+    # Clients act in turn, spread evenly over each second
+    interval = 1 / (actions_per_second * players)
+    sent = 0
+    start = time.perf_counter()
+
+    while time.perf_counter() - start < duration:
+        clients[sent % players].act()
+        sent += 1
+
+        delay = start + sent * interval - time.perf_counter()
+
+        if delay > 0:
+            time.sleep(delay)
+
+    elapsed = time.perf_counter() - start
+
+    # The server's own measurements of its ticks
+    stats_client = clients[0]
+    stats_client.client.emit('request stats')
+
+    deadline = time.monotonic() + 5
+
+    while stats_client.stats is None and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    events = {}
+
+    for client in clients:
+        for event, received in client.received.items():
+            if event not in events.keys():
+                events[event] = {'count': 0, 'bytes': 0}
+
+            events[event]['count'] += received['count']
+            events[event]['bytes'] += received['bytes']
+
+        client.disconnect()
+
+    received = [
+        sum(e['bytes'] for e in client.received.values())
+        for client in clients
+    ]
+
+    logins = [c.login_duration for c in clients if c.login_duration]
+
+    return {
+        'server': stats_client.stats,
+        'logins': dict(summarize(logins), count=len(logins)),
+        'actions': {
+            'count': sent,
+            'per_second': sent / elapsed
+        },
+        'received': {
+            'count': sum(e['count'] for e in events.values()),
+            'bytes': sum(e['bytes'] for e in events.values()),
+            'events': events
+        },
+        'per_player': {
+            'bytes': sum(received) / players,
+            'bytes_per_second': sum(received) / players / elapsed,
+            'max_bytes': max(received)
+        }
+    }
+
+
+# Returns the numbers in a set of results, by their path (e.g.
+#     "ticks.p99")
+def flatten(results, prefix=''):
+    values = {}
+
+    for key, value in results.items():
+        path = prefix + str(key)
+
+        if isinstance(value, dict):
+            values.update(flatten(value, path + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[path] = value
+
+    return values
+
+
+# Prints how each number in a set of results has changed since a baseline
+def compare(results, baseline):
+    current = flatten(results)
+    previous = flatten(baseline)
+
+    print(f'{"":<40} {"baseline":>12} {"now":>12} {"change":>8}',
+          file=sys.stderr)
+
+    for path, value in current.items():
+        if path.startswith('config.') or path not in previous.keys():
+            continue
+
+        before = previous[path]
+        change = f'{(value - before) / before * 100:+.1f}%' if before else ''
+
+        print(f'{path:<40} {before:>12.4g} {value:>12.4g} {change:>8}',
+              file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Game server load benchmark')
+
+    parser.add_argument('--players', type=int, default=40)
+    parser.add_argument('--ticks', type=int, default=300)
+    parser.add_argument('--tick-rate', type=float, default=1)
+    parser.add_argument('--levels', default=','.join(default_levels))
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--memory-entities', type=int, default=20000)
+
+    parser.add_argument('--swarm', action='store_true')
+    parser.add_argument('--url')
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--actions-per-second', type=float, default=4)
+
+    parser.add_argument('--output')
+    parser.add_argument('--baseline')
+
+    args = parser.parse_args()
+
+    # Logging every event would be measured along with the world
+    log.logger.setLevel('warning')
+
+    results = {
+        'config': {
+            'mode': 'swarm' if args.swarm else 'direct',
+            'players': args.players,
+            'seed': args.seed
+        }
+    }
+
+    if args.swarm:
+        results['config'].update({
+            'duration': args.duration,
+            'actions_per_second': args.actions_per_second
+        })
+
+        process = None
+        url = args.url
+
+        if not url:
+            process, url = startServer(args.tick_rate)
+
+        try:
+            results.update(runSwarm(
+                url,
+                args.players,
+                args.duration,
+                args.actions_per_second,
+                args.seed
+            ))
+        finally:
+            if process:
+                process.terminate()
+                process.wait()
+    else:
+        levels = args.levels.split(',')
+
+        results['config'].update({
+            'ticks': args.ticks,
+            'tick_rate': args.tick_rate,
+            'levels': list(levels)
+        })
+
+        results.update(runDirect(
+            args.players,
+            args.ticks,
+            levels,
+            args.seed,
+            args.tick_rate
+        ))
+
+        if args.memory_entities:
+            results['memory'] = measureMemory(args.memory_entities, args.seed)
+
+    output = json.dumps(results, indent=4)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
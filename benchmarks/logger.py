@@ -0,0 +1,102 @@
+# Measures how long a call to log() takes the caller, compared with printing
+#     each message straight away as log() used to.
+# Run from the root of the repository:
+#     python -m benchmarks.logger [calls]
+from colorama import Fore, Style
+
+import log
+
+import io
+import sys
+import time
+
+
+# The old log(), which printed each message before returning
+def printLog(caller, message, level='log'):
+    print(f'[{Fore.CYAN}', end='')
+    print(f'{caller}{Style.RESET_ALL}] ' + message)
+
+
+def measure(function, calls):
+    start = time.perf_counter()
+
+    for i in range(0, calls):
+        function(i)
+
+    return (time.perf_counter() - start) / calls * 1000000000
+
+
+def benchmark(calls=200000):
+    logger = log.logger
+
+    # Stop the writer thread writing to the terminal. Records are written
+    #     into memory instead, and the buffer is big enough for every call
+    logger.stream = io.StringIO()
+    logger.capacity = calls
+    logger.buffer = log.collections.deque(maxlen=calls)
+
+    results = [('empty call', measure(lambda i: None, calls))]
+
+    # Printed messages go to memory as well, so that it's the cost of
+    #     printing being measured, not the terminal
+    stdout = sys.stdout
+    sys.stdout = io.StringIO()
+
+    results.append(('print (old)', measure(
+        lambda i: printLog('EntityManager', f'New entity added #{i}', 'debug'),
+        calls
+    )))
+
+    sys.stdout = stdout
+
+    # Hold the writer's lock, so that it doesn't run while callers are being
+    #     measured
+    logger.lock.acquire()
+    logger.setLevel('log')
+
+    results.append(('filtered, f-string', measure(
+        lambda i: log.log('EntityManager', f'New entity added #{i}', 'debug'),
+        calls
+    )))
+
+    results.append(('filtered, fields', measure(
+        lambda i: log.log('EntityManager', 'New entity added #{id}', 'debug', id=i),  # noqa
+        calls
+    )))
+
+    logger.setLevel('debug')
+
+    results.append(('buffered, fields', measure(
+        lambda i: log.log('EntityManager', 'New entity added #{id}', 'debug', id=i),  # noqa
+        calls
+    )))
+
+    logger.lock.release()
+
+    # How long the writer thread takes to write each record
+    for log_format in ['text', 'json']:
+        logger.format = log_format
+        logger.buffer.clear()
+
+        for i in range(0, calls):
+            log.log('EntityManager', 'New entity added #{id}', 'debug', id=i)
+
+        start = time.perf_counter()
+        logger.flush()
+
+        results.append((
+            f'writer ({log_format})',
+            (time.perf_counter() - start) / calls * 1000000000
+        ))
+
+    print(f'Calls: {calls}')
+    print(f'{"":>20} {"ns/call":>9}')
+
+    for name, ns in results:
+        print(f'{name:>20} {ns:>9.0f}')
+
+
+if __name__ == '__main__':
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+    benchmark(calls)
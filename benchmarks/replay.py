@@ -0,0 +1,64 @@
+# Runs a journal recorded by a server (see Game/Journal.py) as fast as it can,
+#     and reports how long its ticks took. The world is run again for each
+#     run, and the state it ends up in should be the same every time, and
+#     the same as it was on the server. A change that makes it different
+#     changes what happens in the world.
+# Run from the root of the repository:
+#     python -m benchmarks.replay <journal> [runs]
+import log
+from Game import Journal
+
+import statistics
+import sys
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def benchmark(path, runs=1):
+    # Logging every event would be measured along with the world
+    log.logger.setLevel('warning')
+
+    digests = set()
+
+    print(f'{"run":>4} {"ticks":>7} {"events":>7} {"seconds":>8} '
+          f'{"mean ms":>8} {"p50 ms":>8} {"p99 ms":>8}  digest')
+
+    for run in range(0, runs):
+        replay = Journal.Replay(path)
+        stats = replay.run()
+        durations = stats['tick_durations']
+        digest = replay.digest()
+
+        digests.add(digest)
+
+        mean = statistics.mean(durations) if durations else 0
+
+        print(
+            f'{run:>4} {stats["ticks"]:>7} {stats["events"]:>7} '
+            f'{stats["seconds"]:>8.2f} {mean * 1000:>8.3f} '
+            f'{percentile(durations, 0.5) * 1000:>8.3f} '
+            f'{percentile(durations, 0.99) * 1000:>8.3f}  {digest}'
+        )
+
+    if len(digests) > 1:
+        print('Runs ended in different states')
+        return False
+
+    return True
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: python -m benchmarks.replay <journal> [runs]')
+        sys.exit(2)
+
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+
+    if not benchmark(sys.argv[1], runs):
+        sys.exit(1)
@@ -0,0 +1,114 @@
+# Measures how long it takes to save a world full of monsters to a snapshot
+#     (see Game/Snapshots.py), and to restore it and load its level again.
+#     The restored entities should be the same as the saved ones, so the run
+#     fails if they aren't. Some of the monsters are given a component that
+#     isn't one of the entity store's columns, so that components packed
+#     separately (as extras) are restored too.
+# Run from the root of the repository:
+#     python -m benchmarks.snapshots [entities]
+import log
+from Game import Manager
+from Game import Snapshots
+from benchmarks import load
+
+import math
+import shutil
+import sys
+import tempfile
+import time
+
+
+# Makes a world with a level that has room for a number of monsters (which
+#     aren't spawned yet). Returns the manager and the level's ID
+def makeWorld(size, entities, seed=1):
+    manager = Manager.Manager(seed)
+    level_id = load.addLargeLevel(manager.WorldManager, size, seed, entities)
+
+    manager.WorldManager.loadLevel(level_id, manager.EntityManager)
+
+    return manager, level_id
+
+
+# The entities on a level, as (type, components), in the order they're on it
+def levelEntities(manager, level_id):
+    return [
+        (e.type, e.getComponents())
+        for e in manager.WorldManager.getLevel(level_id).get('entities', [])
+        if e.active
+    ]
+
+
+def benchmark(entities=20000):
+    # Logging every entity would be measured along with the snapshots
+    log.logger.setLevel('warning')
+
+    directory = tempfile.mkdtemp()
+
+    try:
+        # The level has room for every monster, with space to spare
+        size = math.ceil(math.sqrt(entities * 3))
+
+        manager, level_id = makeWorld(size, entities)
+        world_manager = manager.WorldManager
+
+        world_manager.spawnLevelMonsters(
+            level_id,
+            manager.EntityManager,
+            fill=True
+        )
+
+        level_entities = world_manager.getLevel(level_id)['entities']
+
+        for i in range(0, len(level_entities), 10):
+            level_entities[i].setComponent('label', {'text': f'#{i}'})
+
+        saved = levelEntities(manager, level_id)
+        snapshots = Snapshots.Snapshots(manager, directory)
+
+        start = time.perf_counter()
+        job = snapshots.capture()
+        capture = time.perf_counter() - start
+
+        start = time.perf_counter()
+        snapshots.write(job)
+        write = time.perf_counter() - start
+
+        # A new world, as after a restart, with the level not loaded yet
+        manager = Manager.Manager(1)
+        load.addLargeLevel(manager.WorldManager, size, 1, entities)
+
+        start = time.perf_counter()
+        Snapshots.Snapshots(manager, directory).restore()
+        restore = time.perf_counter() - start
+
+        start = time.perf_counter()
+        manager.WorldManager.loadLevel(level_id, manager.EntityManager)
+        reload = time.perf_counter() - start
+
+        restored = levelEntities(manager, level_id)
+    finally:
+        shutil.rmtree(directory)
+
+    print(f'Entities: {len(saved)}')
+    print(f'{"":>10} {"ms":>9}')
+
+    for name, seconds in [
+        ('capture', capture),
+        ('write', write),
+        ('restore', restore),
+        ('load', reload)
+    ]:
+        print(f'{name:>10} {seconds * 1000:>9.1f}')
+
+    if restored != saved:
+        print('Restored entities don\'t match the saved ones')
+        return False
+
+    return True
+
+
+if __name__ == '__main__':
+    entities = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    if not benchmark(entities):
+        sys.exit(1)
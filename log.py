@@ -1,20 +1,173 @@
 from colorama import init, Fore, Style
 
+import atexit
+import collections
+import json
+import os
+import sys
+import threading
+import time
+
 init()  # colorama
 
 
-def log(caller, message, level='log'):
+# Logging that doesn't hold up the caller. log() only checks the level and
+#     puts a record in a buffer; a background thread formats and writes
+#     records in batches.
+# Messages can have fields, which are only filled in when the record is
+#     written, so that messages which are filtered out cost nothing to build:
+#     log('EntityManager', 'New entity added #{id}', 'debug', id=ent_id)
+# Fields are also written separately when writing JSON lines.
+# Set by environment variables:
+#     LOG_LEVEL: the lowest level that's written (default: debug)
+#     LOG_FORMAT: text (default) or json, for one JSON object per line
+levels = {
+    'debug': 10,
+    'log': 20,
+    'warning': 30,
+    'error': 40,
+    'fatal error': 50
+}
+
+colors = {
+    'debug': Fore.CYAN,
+    'log': Fore.GREEN,
+    'warning': Fore.YELLOW,
+    'error': Fore.RED,
+    'fatal error': Fore.MAGENTA
+}
+
+
+class Logger:
+    def __init__(self, level='debug', log_format='text', capacity=65536,
+                 interval=0.05, stream=None):
+        self.setLevel(level)
+        self.format = log_format
+        self.interval = interval  # Seconds between writes
+        self.stream = stream
+
+        # Records waiting to be written. When the buffer is full, the oldest
+        #     records are dropped rather than making callers wait
+        self.capacity = capacity
+        self.buffer = collections.deque(maxlen=capacity)
+        self.dropped = 0
+
+        self.lock = threading.Lock()  # Held while writing
+        self.thread = None
+
+    # Starts the thread that writes records. Threads don't survive a fork, so
+    #     forked processes start their own
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    # Writes all buffered records
+    def flush(self):
+        with self.lock:
+            lines = []
+
+            while True:
+                try:
+                    record = self.buffer.popleft()
+                except IndexError:
+                    break
+
+                lines.append(self.formatRecord(record))
+
+            if self.dropped:
+                lines.append(self.formatRecord((
+                    time.time(),
+                    'warning',
+                    'log',
+                    '{dropped} records were dropped (buffer full)',
+                    {'dropped': self.dropped}
+                )))
+
+                self.dropped = 0
+
+            if lines:
+                stream = self.stream or sys.stdout
+
+                stream.write('\n'.join(lines) + '\n')
+                stream.flush()
+
+    def formatRecord(self, record):
+        timestamp, level, caller, message, fields = record
+
+        if fields:
+            try:
+                message = message.format(**fields)
+            except (KeyError, IndexError, ValueError):
+                pass
+
+        if self.format == 'json':
+            entry = {
+                'time': round(timestamp, 6),
+                'level': level,
+                'caller': caller,
+                'message': message
+            }
+
+            if fields:
+                entry['fields'] = fields
+
+            return json.dumps(entry, default=str)
+
+        return f'[{colors.get(level, "")}{caller}{Style.RESET_ALL}] {message}'
+
+    # Sets the lowest level that's written. Levels that aren't known are
+    #     treated as 'log'
+    def setLevel(self, level):
+        self.threshold = levels.get(level, levels['log'])
+
+        # log() only has to look a level up in here to filter it out
+        self.filtered = {
+            name for name, value in levels.items() if value < self.threshold
+        }
+
+    # Returns whether messages of a level would be written, for callers that
+    #     need to do work to build a message
+    def enabled(self, level):
+        return level not in self.filtered
+
+    # Sets up the logger again in a forked process. Records buffered before
+    #     the fork are left for the parent to write
+    def restart(self):
+        self.buffer.clear()
+        self.dropped = 0
+
+        self.lock = threading.Lock()
+        self.start()
+
+
+logger = Logger(
+    os.environ.get('LOG_LEVEL', 'debug'),
+    os.environ.get('LOG_FORMAT', 'text')
+)
+
+logger.start()
+
+# Write whatever is left when exiting (e.g. after a fatal error)
+atexit.register(logger.flush)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=logger.restart)
+
+
+def log(caller, message, level='log', **fields):
+    if level in logger.filtered:
+        return
+
+    if len(logger.buffer) == logger.capacity:
+        logger.dropped += 1
+
+    logger.buffer.append((time.time(), level, caller, message, fields))
+
+    # The process is probably about to exit, so don't leave it buffered
     if level == 'fatal error':
-        print(f'[{Fore.MAGENTA}', end='')
-    elif level == 'error':
-        print(f'[{Fore.RED}', end='')
-    elif level == 'warning':
-        print(f'[{Fore.YELLOW}', end='')
-    elif level == 'log':
-        print(f'[{Fore.GREEN}', end='')
-    elif level == 'debug':
-        print(f'[{Fore.CYAN}', end='')
-    else:
-        print('[', end='')
-
-    print(f'{caller}{Style.RESET_ALL}] ' + message)
+        logger.flush()
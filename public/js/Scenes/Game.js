@@ -3,6 +3,11 @@
 class SceneGame extends Phaser.Scene {
     constructor() {
         super({ key: 'game' });
+
+        // The tiles of levels we've been on, so that they don't need to be
+        //     sent again. Level ID -> { version, tiles }
+        this.level_cache = {};
+        this.max_cached_levels = 16;
     }
 
     preload() {
@@ -40,6 +45,103 @@ class SceneGame extends Phaser.Scene {
         });
     }
 
+    // Levels are sent without their tiles, which follow in chunks. The level
+    //     is set once all of them have arrived
+    receiveLevel(level) {
+        if (level.transfer.cached) {
+            const cached = this.level_cache[level.id];
+
+            // The tiles weren't sent because we said we have them, but we
+            //     don't (any more), so ask again without saying so
+            if (!cached || cached.version != level.transfer.version) {
+                socket.emit('request present level', {});
+                return;
+            }
+
+            level.level.tiles = cached.tiles;
+            this.setLevel(level);
+            return;
+        }
+
+        this.incoming_level = level;
+        this.incoming_chunks = 0;
+
+        level.level.tiles = new Array(level.level.width * level.level.height);
+
+        if (level.transfer.chunks == 0) {
+            this.cacheLevel(level);
+            this.setLevel(level);
+        }
+    }
+
+    // Remembers the tiles of a level. The oldest level is forgotten if too
+    //     many are remembered
+    cacheLevel(level) {
+        delete this.level_cache[level.id];
+
+        const cached_ids = Object.keys(this.level_cache);
+
+        if (cached_ids.length >= this.max_cached_levels) {
+            delete this.level_cache[cached_ids[0]];
+        }
+
+        this.level_cache[level.id] = {
+            version: level.transfer.version,
+            tiles: level.level.tiles
+        };
+    }
+
+    // The versions of the levels we have the tiles of. Level ID -> version
+    heldLevels() {
+        let held = {};
+
+        for (const level_id in this.level_cache) {
+            held[level_id] = this.level_cache[level_id].version;
+        }
+
+        return held;
+    }
+
+    // Chunks are either tile codes, or runs of tiles (a tile code followed by
+    //     a 16 bit little-endian count). Codes are turned into tile types
+    //     with the level's palette
+    receiveLevelChunk(chunk) {
+        const level = this.incoming_level;
+
+        if (!level || chunk.level != level.id
+            || chunk.version != level.transfer.version) {
+            return;
+        }
+
+        const palette = level.transfer.palette;
+        const tiles = level.level.tiles;
+        const data = new Uint8Array(chunk.data);
+
+        let index = chunk.start;
+
+        if (chunk.encoding == 'runs') {
+            for (let i = 0; i + 2 < data.length; i += 3) {
+                const count = data[i + 1] | (data[i + 2] << 8);
+
+                for (let j = 0; j < count; j++) {
+                    tiles[index++] = palette[data[i]];
+                }
+            }
+        } else {
+            for (let i = 0; i < data.length; i++) {
+                tiles[index++] = palette[data[i]];
+            }
+        }
+
+        this.incoming_chunks++;
+
+        if (this.incoming_chunks == level.transfer.chunks) {
+            this.incoming_level = null;
+            this.cacheLevel(level);
+            this.setLevel(level);
+        }
+    }
+
     setLevel(level) {
         this.level = level;
 
@@ -83,6 +185,7 @@ class SceneGame extends Phaser.Scene {
         // Center the map and zoom to the specified zoom amount for this level.
         // Small maps can zoom in (by default) so that it doesn't appear weird
         //     to the user, or large maps can start zoomed out
+        this.cameras.main.stopFollow();
         this.cameras.main.centerOn(
             (level.level.width * level.level.tile_width) / 2,
             (level.level.height * level.level.tile_height) / 2
@@ -122,12 +225,80 @@ class SceneGame extends Phaser.Scene {
                             pos_y,
                             this.level.entities[i].components.sprite.sprite
                         ).setOrigin(0, 0);
+
+                    // On levels too big to fit on the screen, keep the
+                    //     player in view
+                    if (this.level.entities[i].id == this.level.player
+                        && !this.levelFitsOnScreen()) {
+                        this.cameras.main.startFollow(
+                            this.level.entities[i].image
+                        );
+                    }
                 }
             }
         }
     }
 
-    // Given updated entity data, updates those entities locally
+    levelFitsOnScreen() {
+        const camera = this.cameras.main;
+        const level = this.level.level;
+
+        return level.width * level.tile_width * camera.zoom <= camera.width
+            && level.height * level.tile_height * camera.zoom <= camera.height;
+    }
+
+    // Applies a batch of changes to the level
+    updateLevel(update) {
+        // Ignore changes to a level that we're no longer on
+        if (!this.level || update.level != this.level.id) {
+            return;
+        }
+
+        for (let i = 0; i < update.destroy.length; i++) {
+            this.destroyEntity(update.destroy[i]);
+        }
+
+        // Entities that have gone out of view on big levels
+        if (update.leave) {
+            for (let i = 0; i < update.leave.length; i++) {
+                this.destroyEntity(update.leave[i]);
+            }
+        }
+
+        if (update.entities.length > 0) {
+            this.updateEntities(update.entities.map(this.decodeEntity));
+        }
+    }
+
+    // Entity changes are sent as arrays to save space:
+    //     [id] if the entity is no longer active,
+    //     [id, x, y] if only its position has changed, or
+    //     [id, x, y, components] if other components have changed, where x
+    //         and y are null if its position hasn't changed.
+    // Turns one back into the usual entity form
+    decodeEntity(encoded) {
+        let entity = {
+            id: encoded[0],
+            active: encoded.length > 1,
+            components: {}
+        };
+
+        if (encoded.length > 3) {
+            entity.components = encoded[3];
+        }
+
+        if (encoded.length > 1 && encoded[1] !== null) {
+            entity.components.position = {
+                x: encoded[1],
+                y: encoded[2]
+            };
+        }
+
+        return entity;
+    }
+
+    // Given updated entity data, updates those entities locally.
+    // Only components that have changed are sent for known entities
     updateEntities(updates) {
         if (!this.level.entities) {
             this.level.entities = updates;
@@ -149,7 +320,10 @@ class SceneGame extends Phaser.Scene {
 
                     // Update data individually, so that data that has been
                     //     added locally isn't wiped away
-                    this.level.entities[j].components = updates[i].components;
+                    Object.assign(
+                        this.level.entities[j].components,
+                        updates[i].components
+                    );
 
                     break;
                 }
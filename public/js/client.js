@@ -40,23 +40,28 @@ $(() => {
 
     // Server has sent us the data for the level we are on
     socket.on('present level', (level) => {
-        // Forward the data to the Game scene to render the level
-        game.scene.getScene('game').setLevel(level);
+        // Forward the data to the Game scene, which renders the level once
+        //     its tiles have arrived
+        game.scene.getScene('game').receiveLevel(level);
     });
 
-    // The server is telling us that we've changed level
-    socket.on('level change', () => {
-        socket.emit('request present level');
+    // Part of the tiles of the level we are on
+    socket.on('level chunk', (chunk) => {
+        game.scene.getScene('game').receiveLevelChunk(chunk);
     });
 
-    // The server has sent updated entity data
-    socket.on('entity updates', (updates) => {
-        game.scene.getScene('game').updateEntities(updates);
+    // The server is telling us that we've changed level
+    socket.on('level change', () => {
+        socket.emit(
+            'request present level',
+            game.scene.getScene('game').heldLevels()
+        );
     });
 
-    // The server wants us to destroy an entity
-    socket.on('destroy entity', (entity) => {
-        game.scene.getScene('game').destroyEntity(entity);
+    // The server has sent a batch of changes to the level we are on: updated
+    //     entity data, and entities that need to be destroyed
+    socket.on('level update', (update) => {
+        game.scene.getScene('game').updateLevel(update);
     });
 
 
@@ -1,30 +1,98 @@
 from log import log
+from Game import FrontEnds
+from Game import Handlers
+from Game import InputQueue
+from Game import Journal
 from Game import Manager
+from Game import Scheduler
+from Game import Sessions
+from Game import Shards
+from Game import Snapshots
+from Game import WorldManager
 
 import json
+import multiprocessing
 import os
 
 import eventlet
+import eventlet.tpool
 import socketio
 
 
 # -----------------------------------------------------------------------------
 #                                                                    Game Setup
 # -----------------------------------------------------------------------------
-manager = Manager.Manager()
+# How many processes the world is run in. With more than one, levels are split
+#     between worker processes, and the process running the world only passes
+#     messages between them and clients
+workers = 1
+
+if 'WORKERS' in os.environ.keys():
+    workers = int(os.environ['WORKERS'])
+
+# How many processes clients connect to. With more than one, the world is run
+#     in a process of its own, and front-end N listens on port + N. Clients
+#     need to keep talking to the same front-end, so front-ends should be
+#     behind a load balancer with sticky sessions
+frontends = 1
+
+if 'FRONTENDS' in os.environ.keys():
+    frontends = int(os.environ['FRONTENDS'])
+
+# How many times per second the world is updated
+tick_rate = 1
+
+if 'TICK_RATE' in os.environ.keys():
+    tick_rate = float(os.environ['TICK_RATE'])
+
+# How many times per second players' actions are handled, which is also the
+#     most times per second that a player can move (see InputQueue)
+move_rate = 10
+
+if 'MOVE_RATE' in os.environ.keys():
+    move_rate = float(os.environ['MOVE_RATE'])
+
+# Where the world is saved, so that it can be restored after a restart. Not
+#     saved unless set. The world can't be saved when it's split between
+#     workers
+snapshot_directory = None
+snapshot_interval = 60
+
+if 'SNAPSHOT_DIR' in os.environ.keys():
+    snapshot_directory = os.environ['SNAPSHOT_DIR']
+
+if 'SNAPSHOT_INTERVAL' in os.environ.keys():
+    snapshot_interval = float(os.environ['SNAPSHOT_INTERVAL'])
+
+if snapshot_directory and workers > 1:
+    log('server.py', 'Snapshots aren\'t saved with WORKERS > 1', 'warning')
+
+# Where the events that reach the world are recorded, so that they can be
+#     replayed later (see Journal). Not recorded unless set. Only a world run
+#     by one process from scratch can be replayed, so nothing is recorded
+#     with WORKERS > 1, FRONTENDS > 1 or SNAPSHOT_DIR
+journal_path = None
+
+if 'JOURNAL' in os.environ.keys():
+    journal_path = os.environ['JOURNAL']
+
+    if workers > 1 or frontends > 1 or snapshot_directory:
+        log(
+            'server.py',
+            'Journals aren\'t recorded with WORKERS > 1, FRONTENDS > 1 or '
+            'SNAPSHOT_DIR',
+            'warning'
+        )
+
+        journal_path = None
 
 # Message Of The Day
 motd = 'MOTD: Welcome to v0.000...001 of Prismal Totality!'
 
-# Stats
-players_online = 0
-
 
 # -----------------------------------------------------------------------------
 #                                                          Initialize Socket.io
 # -----------------------------------------------------------------------------
-sio = socketio.Server()
-
 # Try to load the list of static files that the server should reveal
 static_files_file = 'config/static_files.json'
 static_files = None
@@ -42,51 +110,35 @@ except json.decoder.JSONDecodeError:
         'warning'
     )
 
-# Define the app itself
-app = socketio.WSGIApp(sio, static_files=static_files)
+# These are set up for the process that clients connect to in main
+sio = None
+app = None
+sessions = None
+handlers = None  # What client events are passed to (e.g. Handlers.Handlers)
 
 
 # -----------------------------------------------------------------------------
 #                                                         Socket.io Interaction
 # -----------------------------------------------------------------------------
-clients = {}  # A dictionary of clients, including ones that have disconnected
-
 # When a client connects, begin to store their information
-@sio.on('connect')
 def connect(sid, env):
-    log('server.py', f'Connected: {sid}', 'debug')
+    log('server.py', 'Connected: {sid}', 'debug', sid=sid)
 
-    clients[sid] = {
-        'online': True
-    }
-
-    global players_online
-    players_online += 1
+    sessions.connect(sid)
 
 # When a client disconnects, mark them as such
-@sio.on('disconnect')
 def disconnect(sid):
-    log('server.py', f'Disconnected: {sid}', 'debug')
-
-    clients[sid]['online'] = False
-    clients[sid]['logged in'] = False
+    log('server.py', 'Disconnected: {sid}', 'debug', sid=sid)
 
-    manager.removePlayer(sid)
-    manager.emitUpdates(sio)
-
-    global players_online
-    players_online -= 1
+    sessions.disconnect(sid)
+    handlers.disconnect(sid)
 
 # A user has logged in
-@sio.on('login')
 def login(sid, username):
     log('server.py', f'Login of {username}')
 
-    clients[sid]['username'] = username
-    clients[sid]['logged in'] = True
-
-    manager.addPlayer(sid, username)
-    manager.emitUpdates(sio)
+    sessions.login(sid, username)
+    handlers.login(sid, username)
 
     sio.emit('login success', room=sid)
 
@@ -95,68 +147,74 @@ def login(sid, username):
 
     sio.emit(
         'msg',
-        f'There are currently {players_online} players online',
+        f'There are currently {sessions.online()} players online',
         room=sid
     )
 
-# A user has requested the data of the level they're on.
-# After they're sent the level, they'll want to recieve updates for
-#     anything that happens on the level, so they need to be "linked" with the
-#     level as well
-@sio.on('request present level')
-def request_present_level(sid):
-    level = manager.getPresentLevel(sid)
-
-    if level:
-        # Remove inactive entities first
-        if 'entities' in level.keys():
-            for e in level['entities'][:]:
-                if not e['active']:
-                    level['entities'].remove(e)
-
-        # Send the level to the client
-        sio.emit('present level', level, room=sid)
-        sio.emit('msg', 'Moved to level ' + level['title'], room=sid)
-
-        manager.linkPlayerToLevel(sid, level['id'])
-
-        log(
-            'server.py',
-            f'Sent level {level["id"]} to {clients[sid]["username"]}',
-            'debug'
-        )
+# A user has requested the data of the level they're on
+def request_present_level(sid, held=None):
+    handlers.requestPresentLevel(sid, held)
 
 # Handles a user action
-@sio.on('action')
 def action(sid, action_type, details):
-    response = manager.action(sid, action_type, details)
+    handlers.action(sid, action_type, details)
 
-    if response:
-        if response['response'] == 'message':
-            sio.emit('msg', response['data'], room=sid)
+# Sends statistics about how long server ticks are taking
+def request_stats(sid):
+    handlers.requestStats(sid)
 
-        elif response['response'] == 'level change':
-            sio.emit('level change', room=sid)
 
-            log(
-                'server.py',
-                f'User {clients[sid]["username"]} -> Level {response["data"]}',
-                'debug'
-            )
+# Creates the socket.io server and app. A client manager can be given to
+#     share emits with other processes (e.g. FrontEnds.QueueManager)
+def createServer(client_manager=None):
+    global sio, app
+
+    sio = socketio.Server(client_manager=client_manager)
 
-    # Emit any changes that the action might have caused
-    manager.emitUpdates(sio)
+    sio.on('connect', connect)
+    sio.on('disconnect', disconnect)
+    sio.on('login', login)
+    sio.on('request present level', request_present_level)
+    sio.on('action', action)
+    sio.on('request stats', request_stats)
+
+    # Define the app itself
+    app = socketio.WSGIApp(sio, static_files=static_files)
 
 
 # -----------------------------------------------------------------------------
 #                                                            Management Threads
 # -----------------------------------------------------------------------------
 def updateThread():
+    scheduler.run()
+
+# Handles the actions that players have sent, a round at a time
+def inputThread():
+    input_scheduler.run()
+
+# Reads level files that are likely to be needed soon, without blocking
+def preloadThread():
     while True:
-        manager.doUpdates()
-        manager.emitUpdates(sio)
+        manager.WorldManager.preloadLevels(eventlet.tpool.execute)
+
+        sio.sleep(0.5)
 
-        sio.sleep(1)
+# Carries out what the worker processes want to send to clients
+def relayThread():
+    handlers.run(sio.sleep)
+
+# The entry point of front-end processes, which pass their clients' events
+#     to the world
+def runFrontEnd(index, bus, players_online, port):
+    global sessions, handlers
+
+    createServer(FrontEnds.QueueManager(bus, index))
+
+    sessions = Sessions.Sessions(players_online)
+    handlers = FrontEnds.EventForwarder(bus)
+
+    log('server.py', f'Starting front-end {index} on port {port}')
+    eventlet.wsgi.server(eventlet.listen(('', port)), app)
 
 
 # -----------------------------------------------------------------------------
@@ -169,8 +227,100 @@ if __name__ == '__main__':
     if 'PORT' in os.environ.keys():
         port = int(os.environ['PORT'])
 
+    if frontends > 1:
+        bus = FrontEnds.MessageBus(frontends)
+        players_online = multiprocessing.Value('i', 0)
+
+        processes = [multiprocessing.Process(
+            target=FrontEnds.runWorld,
+            args=(
+                bus,
+                workers,
+                WorldManager.WorldManager().defaultLevel(),
+                tick_rate,
+                snapshot_directory,
+                snapshot_interval,
+                move_rate
+            )
+        )]
+
+        for i in range(0, frontends):
+            processes.append(multiprocessing.Process(
+                target=runFrontEnd,
+                args=(i, bus, players_online, port + i)
+            ))
+
+        for process in processes:
+            process.start()
+
+        for process in processes:
+            process.join()
+
+        exit()
+
+    createServer()
+    sessions = Sessions.Sessions()
+
     # Start threads
-    sio.start_background_task(updateThread)
+    if workers > 1:
+        # The workers run the world, so all this process does is pass
+        #     messages
+        handlers = Shards.ShardRouter(
+            sio,
+            workers,
+            WorldManager.WorldManager().defaultLevel(),
+            tick_rate,
+            move_rate
+        )
+
+        handlers.start()
+        sio.start_background_task(relayThread)
+    else:
+        journal = None
+        seed = None
+
+        # The seed is recorded, so that a replay makes the same world
+        if journal_path:
+            seed = int.from_bytes(os.urandom(8), 'little')
+            journal = Journal.Journal(journal_path, seed)
+
+        manager = Manager.Manager(seed)
+        scheduler = Scheduler.Scheduler(sio.sleep, tick_rate)
+
+        if journal:
+            manager.WorldManager.clock = journal.clock
+            scheduler.addPhase('journal', journal.tick)
+
+        scheduler.addPhase('spawn', manager.updateSpawns)
+        scheduler.addPhase('ai', manager.updateAI)
+        scheduler.addPhase('combat', manager.updateCombat)
+        scheduler.addPhase('evict', manager.updateEviction)
+        scheduler.addPhase('emit', lambda: manager.emitUpdates(sio))
+
+        if snapshot_directory:
+            snapshots = Snapshots.Snapshots(
+                manager,
+                snapshot_directory,
+                snapshot_interval
+            )
+
+            snapshots.restore()
+            scheduler.addPhase('snapshot', snapshots.update)
+
+        handlers = Handlers.Handlers(manager, sio, scheduler)
+
+        if journal:
+            handlers = Journal.Recorder(handlers, journal)
+            log('server.py', f'Recording journal to {journal_path}')
+
+        handlers = InputQueue.InputQueue(handlers)
+
+        input_scheduler = Scheduler.Scheduler(sio.sleep, move_rate)
+        input_scheduler.addPhase('input', handlers.process)
+
+        sio.start_background_task(updateThread)
+        sio.start_background_task(inputThread)
+        sio.start_background_task(preloadThread)
 
     # Actually run the server
     log('server.py', 'Starting server')